@@ -10,7 +10,7 @@ setup(
     include_package_data=True,
     install_requires=[
         'requests==2.32.3',
-        'websocket-client==1.8.0',
+        'websockets==12.0',
         'textual==0.63.6',
         'rich-pixels==3.0.1',
         'platformdirs==4.2.2',
@@ -1,9 +1,12 @@
 import requests
 from urllib.parse import urljoin
 import json
-from typing import Optional, List, Tuple, Any, Dict
-import websocket
+from typing import Callable, Optional, List, Tuple, Any, Dict
 import ssl
+import time
+import uuid
+from websockets.exceptions import WebSocketException
+from websockets.sync.client import connect
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 
@@ -16,6 +19,9 @@ class ServerMiddleware(requests.Session):
     def request(self, method: str, url: str, *args, **kwargs) -> requests.Response:
         joined_url = urljoin(self.base_url, url)
         kwargs["verify"] = self.verify
+        # Every request starts a trace, which the servers carry along.
+        headers = kwargs.pop("headers", None) or {}
+        kwargs["headers"] = {"X-Trace-Id": uuid.uuid4().hex, **headers}
         return super().request(method, joined_url, *args, **kwargs)
 
 
@@ -43,9 +49,9 @@ class UserManager:
         return result.get("success", False)
 
     def find_by_username(
-        self, username: str, limit: int = 100, offset: int = 0
+        self, username: str, limit: int = 100, offset: int = 0, mode: str = "substring"
     ) -> List[Dict[str, Any]]:
-        data = {"username": username, "limit": limit, "offset": offset}
+        data = {"username": username, "limit": limit, "offset": offset, "mode": mode}
         result = self._post("user/find_by_username", data)
         return result.get("result", [])
 
@@ -120,13 +126,39 @@ class PublicManager:
         }
         self.session.post("public/send_message", json=data)
 
+    def send_messages(self, messages: List[Dict[str, Any]]) -> List[int]:
+        result = self.session.post("public/send_messages", json={"messages": messages})
+        return result.json().get("ids", [])
+
     def read_messages(
-        self, limit: int = 100, offset: int = 0, timestamp: str = ""
+        self,
+        limit: int = 100,
+        offset: int = 0,
+        timestamp: str = "",
+        room_name: str = "public_room",
     ) -> List[Dict[str, Any]]:
-        data = {"limit": limit, "offset": offset, "timestamp": timestamp}
+        data = {
+            "limit": limit,
+            "offset": offset,
+            "timestamp": timestamp,
+            "room_name": room_name,
+        }
         result = self.session.post("public/read_messages", json=data)
         return result.json().get("messages", [])
 
+    def read_messages_page(
+        self,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        direction: str = "backward",
+        room_name: str = "public_room",
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        data = {"limit": limit, "direction": direction, "room_name": room_name}
+        if cursor:
+            data["cursor"] = cursor
+        result = self.session.post("public/read_messages", json=data).json()
+        return result.get("messages", []), result.get("next_cursor")
+
 
 class PrivateManager:
     def __init__(self, session: ServerMiddleware):
@@ -143,6 +175,10 @@ class PrivateManager:
         }
         self.session.post("private/send_message", json=data)
 
+    def send_messages(self, messages: List[Dict[str, Any]]) -> List[int]:
+        result = self.session.post("private/send_messages", json={"messages": messages})
+        return result.json().get("ids", [])
+
     def read_messages(
         self,
         sender_id: int,
@@ -161,6 +197,87 @@ class PrivateManager:
         result = self.session.post("private/read_messages", json=data)
         return result.json().get("messages", [])
 
+    def read_messages_page(
+        self,
+        sender_id: int,
+        receiver_id: int,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        direction: str = "backward",
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        data = {
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "limit": limit,
+            "direction": direction,
+        }
+        if cursor:
+            data["cursor"] = cursor
+        result = self.session.post("private/read_messages", json=data).json()
+        return result.get("messages", []), result.get("next_cursor")
+
+
+class NotificationSocket:
+    """Notification websocket that negotiates permessage-deflate.
+
+    Calls `on_open(socket)`, `on_message(socket, message)` and
+    `on_close(socket, code, reason)` like `websocket.WebSocketApp`, and
+    reconnects after a lost connection until `close` is called.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        on_open: Callable,
+        on_message: Callable,
+        on_close: Callable,
+        ssl_context: Optional[ssl.SSLContext] = None,
+    ):
+        self.url = url
+        self.on_open = on_open
+        self.on_message = on_message
+        self.on_close = on_close
+        self.ssl_context = ssl_context
+        self.connection = None
+        self.closed = False
+
+    @property
+    def connected(self) -> bool:
+        return self.connection is not None
+
+    def send(self, data: str) -> None:
+        connection = self.connection
+        if connection is None:
+            raise ConnectionError("The notification socket is not connected")
+        connection.send(data)
+
+    def run_forever(self, reconnect: float = 5) -> None:
+        while not self.closed:
+            code = reason = None
+            try:
+                with connect(
+                    self.url, ssl_context=self.ssl_context, compression="deflate"
+                ) as connection:
+                    self.connection = connection
+                    self.on_open(self)
+                    for message in connection:
+                        self.on_message(self, message)
+                    code = connection.protocol.close_code
+                    reason = connection.protocol.close_reason
+            except (OSError, WebSocketException):
+                pass
+            finally:
+                self.connection = None
+            self.on_close(self, code, reason)
+            if not self.closed:
+                time.sleep(reconnect)
+
+    def close(self) -> None:
+        self.closed = True
+        connection = self.connection
+        if connection is not None:
+            connection.close()
+
 
 class MessengerAPI:
     def __init__(self, ip=None, port=None):
@@ -173,10 +290,11 @@ class MessengerAPI:
         self.endpoint = f"{ip}:{port}"
         url = "https://" + self.endpoint + "/api/"
         verify_ssl = False
-        self.ws_params = {}
+        self.ssl_context = ssl.create_default_context()
         if verify_ssl == False:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-            self.ws_params["cert_reqs"] = ssl.CERT_NONE
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
         self.session = ServerMiddleware(url, verify=verify_ssl)
         self.session.headers.update({"Content-Type": "application/json"})
 
@@ -184,10 +302,13 @@ class MessengerAPI:
         self.public = PublicManager(self.session)
         self.private = PrivateManager(self.session)
 
-    def websocket(self, on_open, on_message, on_close):
-        return websocket.WebSocketApp(
-            "wss://" + self.endpoint + "/notifications/",
+    def websocket(self, on_open, on_message, on_close, user_id=None):
+        # The user id only routes all the sockets of a user to the same node.
+        query = "" if user_id is None else f"?user_id={user_id}"
+        return NotificationSocket(
+            "wss://" + self.endpoint + "/notifications/" + query,
             on_open=on_open,
             on_message=on_message,
             on_close=on_close,
+            ssl_context=self.ssl_context,
         )
@@ -3,11 +3,11 @@ import json
 import os
 import os.path
 import time
+import uuid
 from collections import defaultdict
 from datetime import datetime
 
 # Third-party imports
-import ast
 import pytz
 from platformdirs import user_cache_dir
 from rich.console import Console
@@ -131,6 +131,9 @@ class MessengerApp(App):
             lambda: RichLog(highlight=False, markup=True, id="private")
         )
         self.richlog_public = RichLog(highlight=False, markup=True, id="public")
+        self.last_event_ids = {}
+        # Commands sent on the socket and not acked yet, by client_id
+        self.unacked = {}
 
         super().__init__()
 
@@ -138,16 +141,58 @@ class MessengerApp(App):
         if hasattr(self, "ws") and self.ws:
             self.ws.close()
 
+    def send_over_socket(self, fields: dict) -> bool:
+        """Send a message on the notification socket, which acks it.
+
+        `fields` are the ones of the public or private send route, with a
+        `kind`. Returns False if the socket is not connected. If the socket
+        closes before the ack, the command is sent again when it reopens.
+        """
+        if not self.socket_connected():
+            return False
+        command = {
+            "action": "send",
+            "client_id": uuid.uuid4().hex,
+            "trace_id": uuid.uuid4().hex,
+            **fields,
+        }
+        self.unacked[command["client_id"]] = command
+        try:
+            self.ws.send(json.dumps(command))
+        except Exception:
+            # Sent again by `resend_unacked` once the socket reopens.
+            pass
+        return True
+
+    def resend_unacked(self, ws) -> None:
+        # The server recognizes a command it already stored by its client_id
+        # and only acks it again, so nothing is stored twice.
+        for command in list(self.unacked.values()):
+            ws.send(json.dumps(command))
+
+    def socket_connected(self) -> bool:
+        return bool(hasattr(self, "ws") and self.ws and self.ws.connected)
+
     @work(thread=True, exclusive=True)
     def notification(self):
         def on_message(ws, message):
             try:
                 message = json.loads(message)
-                where = message.get("where", "public")
-                msg = message.get("content", "")
-                self.post_message(LogMessage(msg, where))
             except json.JSONDecodeError:
                 self.post_message(LogMessage("Invalid message format", "public"))
+                return
+            # A batched frame is an array of messages.
+            for item in message if isinstance(message, list) else [message]:
+                if item.get("where") == "ack":
+                    self.unacked.pop(item.get("client_id"), None)
+                    if not item.get("success"):
+                        self.post_message(LogMessage("", "send_failed"))
+                    continue
+                where = item.get("where", "public")
+                msg = item.get("content", "")
+                if "id" in item:
+                    self.last_event_ids[item["channel"]] = item["id"]
+                self.post_message(LogMessage(msg, where))
 
         def on_close(ws, close_status_code, close_msg):
             self.sub_title = "Server connection lost"
@@ -156,14 +201,24 @@ class MessengerApp(App):
             data = {
                 "user_id": self.app.user["user_id"],
                 "session_id": self.app.user["session_id"],
+                # The public log only shows this room.
+                "rooms": ["public_room"],
+                "batch": True,
             }
+            if self.last_event_ids:
+                # Replays what was missed while the connection was lost.
+                data["last_event_ids"] = self.last_event_ids
             ws.send(json.dumps(data))
+            self.resend_unacked(ws)
             self.sub_title = ""
 
         self.ws = self.messenger.websocket(
-            on_open=on_open, on_message=on_message, on_close=on_close
+            on_open=on_open,
+            on_message=on_message,
+            on_close=on_close,
+            user_id=self.app.user["user_id"],
         )
-        self.ws.run_forever(reconnect=5, sslopt=self.messenger.ws_params)
+        self.ws.run_forever(reconnect=5)
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
@@ -194,12 +249,22 @@ class MessengerApp(App):
         self.close()
 
     def on_log_message(self, event: LogMessage) -> None:
+        if event._type == "send_failed":
+            self.richlog_public.write("A message could not be sent.")
+            return
 
-        try:
-            event_data = ast.literal_eval(event.message_obj)
-        except (ValueError, SyntaxError):
+        if event._type == "resync":
             self.richlog_public.write(
-                "Invalid message format, received: " + str(event.message_obj)
+                f"Some {event.message_obj} messages were missed, "
+                "reopen the chat to load them."
+            )
+            return
+
+        # The message row, followed by the name of its sender
+        event_data = event.message_obj
+        if not isinstance(event_data, list) or len(event_data) != 6:
+            self.richlog_public.write(
+                "Invalid message format, received: " + str(event_data)
             )
             return
 
@@ -395,7 +460,7 @@ class PrivateScreen(Screen):
         """Handle actions to perform when the screen is mounted."""
         log = self.query_one("#private")
         try:
-            messages = self.app.messenger.private.read_messages(
+            messages, _ = self.app.messenger.private.read_messages_page(
                 self.app.user["user_id"], self.user_id
             )
         except Exception as ex:
@@ -428,9 +493,18 @@ class PrivateScreen(Screen):
         if not message:
             return
         user_id = self.app.user["user_id"]
-        self.app.messenger.private.send_message(
-            user_id, self.user_id, message, self.app.user["name"]
+        sent = self.app.send_over_socket(
+            {
+                "kind": "private",
+                "receiver_id": self.user_id,
+                "message": message,
+                "name": self.app.user["name"],
+            }
         )
+        if not sent:
+            self.app.messenger.private.send_message(
+                user_id, self.user_id, message, self.app.user["name"]
+            )
         self.query_one("#message").clear()
 
     def on_input_submitted(self) -> None:
@@ -487,7 +561,7 @@ class ChatsScreen(Screen):
         """Load and display public messages."""
         log = self.query_one("#public")
         try:
-            messages = self.app.messenger.public.read_messages()
+            messages, _ = self.app.messenger.public.read_messages_page()
         except Exception as ex:
             self.app.push_screen(
                 AlertScreen("Failed to load messages. Error:" + str(ex), type="Error")
@@ -509,7 +583,7 @@ class ChatsScreen(Screen):
             return
 
         self.query_one("#result_message").update("Latest chats:")
-        for user_id, username in chats:
+        for user_id, username, *_ in chats:
             listview.append(SearchResult(username, user_id))
 
     @on(ListView.Selected, "#search_result")
@@ -580,10 +654,19 @@ class ChatsScreen(Screen):
 
         user_id = self.app.user["user_id"]
 
+        sent = self.app.send_over_socket(
+            {
+                "kind": "public",
+                "room_name": "public_room",
+                "message": message,
+                "name": self.app.user["name"],
+            }
+        )
         try:
-            self.app.messenger.public.send_message(
-                user_id, message, "public_room", self.app.user["name"]
-            )
+            if not sent:
+                self.app.messenger.public.send_message(
+                    user_id, message, "public_room", self.app.user["name"]
+                )
         except Exception as ex:
             self.app.push_screen(AlertScreen("Failed to send message.", type="Error"))
             return
@@ -1,12 +1,17 @@
-from flask import Flask, request, jsonify
-import redis
+from flask import Flask, Response, g, request, jsonify
 import json
-import os
 import logging
+import time
 from datetime import datetime
-from messengerdb import db, Messenger
+from config import Config
+from messengerdb import db, metrics, query_stats, tracing, Messenger
+from messengerdb.cursor import page_body, page_query
+from messengerdb.events import room_channel, user_channel
+from messengerdb.messenger import DEFAULT_ROOM
+from messengerdb.ingest import IngestLagCollector, MessageIngestor
+from messengerdb.storage import storage_for
 from sqlalchemy.exc import SQLAlchemyError
-from functools import wraps
+from functools import partial, wraps
 from email_validator import validate_email
 from password_lib.utils import PasswordUtil
 
@@ -17,43 +22,69 @@ BEGINNING_OF_DATE = datetime(1970, 1, 1, 0, 0, 0)
 app = Flask(__name__)
 password_util = PasswordUtil()
 
-
-# Configuration
-class Config:
-    REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-    REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-    MYSQL_USER = os.getenv("MYSQL_USER")
-    MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
-    MYSQL_HOST = os.getenv("MYSQL_HOST")
-    MYSQL_DATABASE = os.getenv("MYSQL_DATABASE")
-    SQLALCHEMY_DATABASE_URI = (
-        f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DATABASE}"
-    )
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
-    CHECK_SECURE_PASSWORD = True
-
-
 app.config.from_object(Config)
 
-# Initialize Redis client
-redis_client = redis.StrictRedis(
-    host=app.config["REDIS_HOST"], port=app.config["REDIS_PORT"]
-)
+# MySQL and Redis, or their local stand-ins (see `messengerdb/storage.py`)
+storage = storage_for(app.config)
+redis_client = storage.redis()
 
-# Initialize SQLAlchemy
+# Initialize SQLAlchemy; the schema is created by `migrate.py`, or here locally
 db.init_app(app)
+storage.prepare_schema()
 
-# Create database tables
-with app.app_context():
-    db.create_all()
+messenger_db = Messenger(app, redis_client)
+query_stats.configure(
+    app.config["SLOW_QUERY_SECONDS"], app.config["MAX_REQUEST_STATEMENTS"]
+)
+tracing.configure(app.config["TRACE_LOG"])
 
-messenger_db = Messenger(app)
+# In write-behind mode new messages go to a Redis stream drained into MySQL by
+# `ingest_worker.py`; otherwise they are committed before the request returns.
+ingestor = None
+if app.config["INGEST_MODE"] == "stream":
+    ingestor = MessageIngestor(redis_client, db.session)
+    metrics.register_collector(IngestLagCollector(redis_client))
 
 # Logger setup
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    query_stats.start()
+    g.trace_id = tracing.begin(request.headers.get(tracing.HEADER))
+
+
+@app.after_request
+def finish_request(response):
+    # Handlers turn their errors into 500 responses, which are counted here.
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    seconds = time.perf_counter() - g.request_started
+    queries = query_stats.stop(route)
+    metrics.observe_request(
+        route,
+        request.method,
+        response.status_code,
+        seconds,
+        queries.statements,
+        queries.seconds,
+    )
+    tracing.record(
+        "request",
+        seconds,
+        route=route,
+        status=response.status_code,
+        db_statements=queries.statements,
+        db_seconds=queries.seconds,
+        db_commit_seconds=queries.commit_seconds,
+    )
+    tracing.end()
+    response.headers[tracing.HEADER] = g.trace_id
+    return response
+
+
 def session_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -70,6 +101,61 @@ def session_required(f):
     return decorated_function
 
 
+def sent_by_others(messages, field):
+    """Whether any of `messages` names a sender other than the session's user."""
+    user_id = int(request.headers.get("User-Id"))
+    return any(m.get(field) != user_id for m in messages)
+
+
+def store_public(messages, pipe):
+    """Store `(user_id, message, room_name)` triples and return their rows.
+
+    In write-behind mode the rows are queued on `pipe` instead.
+    """
+    if ingestor is not None:
+        return ingestor.enqueue_public(messages, pipe)
+    return messenger_db.public.send_messages(messages)
+
+
+def store_private(messages, pipe):
+    """Store `(sender_id, receiver_id, message)` triples and return their rows.
+
+    In write-behind mode the rows are queued on `pipe` instead.
+    """
+    if ingestor is not None:
+        return ingestor.enqueue_private(messages, pipe)
+    return messenger_db.private.send_messages(messages)
+
+
+def notify(channel, row, name, pipe):
+    """Queue the notification of a stored message row, sent by `name`."""
+    # Compact, since the notification server forwards it to clients as is.
+    payload = json.dumps((*row, name), separators=(",", ":"))
+    messenger_db.events.publish(channel, payload, pipe, tracing.current())
+
+
+def publish(pipe):
+    """Run a pipeline that publishes notifications, timing the round trip."""
+    started = time.perf_counter()
+    pipe.execute()
+    seconds = time.perf_counter() - started
+    metrics.REDIS_PUBLISH_SECONDS.observe(seconds)
+    tracing.record("redis_publish", seconds)
+
+
+def read_page(read, data):
+    """Serve a keyset-paginated read through `read` (a manager's `read_page`)."""
+    direction, query = page_query(data)
+    return jsonify(page_body(direction, query, read(**query)))
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # Served on the container network only; nginx proxies /api/ alone.
+    data, content_type = metrics.render()
+    return Response(data, content_type=content_type)
+
+
 @app.route("/api/user/is_session_valid", methods=["POST"])
 def user_is_session_valid():
     try:
@@ -104,7 +190,8 @@ def user_find_by_username():
         username = data.get("username")
         limit = data.get("limit", 100)
         offset = data.get("offset", 0)
-        result = messenger_db.user.find_by_username(username, limit, offset)
+        mode = data.get("mode", "substring")
+        result = messenger_db.user.find_by_username(username, limit, offset, mode)
         return jsonify({"result": result})
     except Exception as e:
         logger.debug(f"Error finding user by username: {e}")
@@ -229,27 +316,75 @@ def public_send_message():
         data = request.get_json()
         user_id = data.get("user_id")
         message = data.get("message")
-        name = data.get("name")
-        room_name = data.get("room_name")
-        row = messenger_db.public.send_message(user_id, message, room_name)
-        redis_client.publish("public_room", json.dumps((*row, name)))
-        return jsonify({"success": True})
+        room_name = data.get("room_name", DEFAULT_ROOM)
+        pipe = redis_client.pipeline(transaction=False)
+        (row,) = store_public([(user_id, message, room_name)], pipe)
+        # The stored name of the sender, not one sent by the client
+        name = messenger_db.user.names([user_id]).get(user_id)
+        notify(room_channel(room_name), row, name, pipe)
+        messenger_db.room_history.record(row, name, pipe)
+        publish(pipe)
+        return jsonify({"success": True, "id": row[0]})
     except Exception as e:
         logger.debug(f"Error sending public message: {e}")
         return jsonify({"success": False}), 500
 
 
+@app.route("/api/public/send_messages", methods=["POST"])
+@session_required
+def public_send_messages():
+    try:
+        messages = request.get_json().get("messages", [])
+        if len(messages) > app.config["MAX_BATCH_SIZE"]:
+            return jsonify(success=False, message="Too many messages"), 400
+        if sent_by_others(messages, "user_id"):
+            return (
+                jsonify(
+                    success=False, message="Messages must be sent by the session's user"
+                ),
+                403,
+            )
+
+        pipe = redis_client.pipeline(transaction=False)
+        rows = store_public(
+            [
+                (
+                    m.get("user_id"),
+                    m.get("message"),
+                    m.get("room_name", DEFAULT_ROOM),
+                )
+                for m in messages
+            ],
+            pipe,
+        )
+        # Every message is sent by the session's user
+        names = messenger_db.user.names(sorted({row[1] for row in rows}))
+        for row in rows:
+            notify(room_channel(row[3]), row, names.get(row[1]), pipe)
+            messenger_db.room_history.record(row, names.get(row[1]), pipe)
+        publish(pipe)
+        return jsonify({"success": True, "ids": [row[0] for row in rows]})
+    except Exception as e:
+        logger.debug(f"Error sending public messages: {e}")
+        return jsonify({"success": False}), 500
+
+
 @app.route("/api/public/read_messages", methods=["POST"])
 @session_required
 def public_read_messages():
     try:
         data = request.get_json()
+        room_name = data.get("room_name", DEFAULT_ROOM)
+        if "cursor" in data or "direction" in data:
+            read = partial(messenger_db.public.read_page, room_name=room_name)
+            return read_page(read, data)
+
         limit = data.get("limit", 100)
         offset = data.get("offset", 0)
         timestamp = data.get("timestamp", "")
         if timestamp == "":
             timestamp = BEGINNING_OF_DATE
-        result = messenger_db.public.read_messages(limit, offset, timestamp)
+        result = messenger_db.public.read_messages(limit, offset, timestamp, room_name)
         return jsonify({"messages": result})
     except Exception as e:
         logger.debug(f"Error reading public messages: {e}")
@@ -264,16 +399,56 @@ def private_send_message():
         sender_id = data.get("sender_id")
         receiver_id = data.get("receiver_id")
         message = data.get("message")
-        name = data.get("name")
-        row = messenger_db.private.send_message(sender_id, receiver_id, message)
-        redis_client.publish(f"user-{sender_id}", json.dumps((*row, "Me")))
-        redis_client.publish(f"user-{receiver_id}", json.dumps((*row, name)))
-        return jsonify({"success": True})
+        pipe = redis_client.pipeline(transaction=False)
+        (row,) = store_private([(sender_id, receiver_id, message)], pipe)
+        # The stored name of the sender, not one sent by the client
+        name = messenger_db.user.names([sender_id]).get(sender_id)
+        notify(user_channel(sender_id), row, "Me", pipe)
+        notify(user_channel(receiver_id), row, name, pipe)
+        messenger_db.chat_index.record(row, pipe)
+        publish(pipe)
+        return jsonify({"success": True, "id": row[0]})
     except Exception as e:
         logger.debug(f"Error sending private message: {e}")
         return jsonify({"success": False}), 500
 
 
+@app.route("/api/private/send_messages", methods=["POST"])
+@session_required
+def private_send_messages():
+    try:
+        messages = request.get_json().get("messages", [])
+        if len(messages) > app.config["MAX_BATCH_SIZE"]:
+            return jsonify(success=False, message="Too many messages"), 400
+        if sent_by_others(messages, "sender_id"):
+            return (
+                jsonify(
+                    success=False, message="Messages must be sent by the session's user"
+                ),
+                403,
+            )
+
+        pipe = redis_client.pipeline(transaction=False)
+        rows = store_private(
+            [
+                (m.get("sender_id"), m.get("receiver_id"), m.get("message"))
+                for m in messages
+            ],
+            pipe,
+        )
+        # Every message is sent by the session's user
+        names = messenger_db.user.names(sorted({row[1] for row in rows}))
+        for row in rows:
+            notify(user_channel(row[1]), row, "Me", pipe)
+            notify(user_channel(row[2]), row, names.get(row[1]), pipe)
+            messenger_db.chat_index.record(row, pipe)
+        publish(pipe)
+        return jsonify({"success": True, "ids": [row[0] for row in rows]})
+    except Exception as e:
+        logger.debug(f"Error sending private messages: {e}")
+        return jsonify({"success": False}), 500
+
+
 @app.route("/api/private/read_messages", methods=["POST"])
 @session_required
 def private_read_messages():
@@ -281,6 +456,10 @@ def private_read_messages():
         data = request.get_json()
         sender_id = data.get("sender_id")
         receiver_id = data.get("receiver_id")
+        if "cursor" in data or "direction" in data:
+            read = partial(messenger_db.private.read_page, sender_id, receiver_id)
+            return read_page(read, data)
+
         limit = data.get("limit", 100)
         offset = data.get("offset", 0)
         timestamp = data.get("timestamp", "")
@@ -0,0 +1,491 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from functools import partial, wraps
+
+from email_validator import validate_email
+from password_lib.utils import PasswordUtil
+from sanic import Sanic
+from sanic.response import json as jsonify, raw
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from config import Config
+from messengerdb import metrics, query_stats, tracing
+from messengerdb.aio import AsyncMessageIngestor, AsyncMessenger
+from messengerdb.cursor import page_body, page_query
+from messengerdb.events import room_channel, user_channel
+from messengerdb.messenger import DEFAULT_ROOM
+from messengerdb.ingest import IngestLagCollector
+from messengerdb.storage import storage_for
+
+# The asyncio counterpart of `app.py`: the same routes and the same responses,
+# served by one event loop per worker instead of one thread per request.
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+BEGINNING_OF_DATE = datetime(1970, 1, 1, 0, 0, 0)
+
+app = Sanic("messenger")
+password_util = PasswordUtil()
+
+app.update_config(Config)
+
+storage = storage_for(app.config)
+storage.prepare_schema()
+redis_client = storage.async_redis()
+
+engine = create_async_engine(app.config.ASYNC_DATABASE_URI, pool_recycle=3600)
+sessions = async_sessionmaker(engine)
+
+messenger_db = AsyncMessenger(app.config, sessions, redis_client)
+query_stats.configure(app.config.SLOW_QUERY_SECONDS, app.config.MAX_REQUEST_STATEMENTS)
+tracing.configure(app.config.TRACE_LOG)
+
+ingestor = None
+if app.config.INGEST_MODE == "stream":
+    ingestor = AsyncMessageIngestor(redis_client, sessions)
+    # Prometheus collects synchronously, so the lag collector gets its own client.
+    metrics.register_collector(IngestLagCollector(storage.redis()))
+
+# Logger setup
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+@app.on_request
+async def start_request(request):
+    request.ctx.started = time.perf_counter()
+    query_stats.start()
+    request.ctx.trace_id = tracing.begin(request.headers.get(tracing.HEADER))
+
+
+@app.on_response
+async def finish_request(request, response):
+    # Handlers turn their errors into 500 responses, which are counted here.
+    route = "/" + request.route.path if request.route else "unmatched"
+    seconds = time.perf_counter() - request.ctx.started
+    queries = query_stats.stop(route)
+    metrics.observe_request(
+        route,
+        request.method,
+        response.status,
+        seconds,
+        queries.statements,
+        queries.seconds,
+    )
+    tracing.record(
+        "request",
+        seconds,
+        route=route,
+        status=response.status,
+        db_statements=queries.statements,
+        db_seconds=queries.seconds,
+        db_commit_seconds=queries.commit_seconds,
+    )
+    tracing.end()
+    response.headers[tracing.HEADER] = request.ctx.trace_id
+
+
+@app.before_server_start
+async def start_invalidation_listener(app, loop):
+    app.add_task(messenger_db.session_cache.listen(), name="session-invalidations")
+
+
+@app.after_server_stop
+async def close_connections(app, loop):
+    await engine.dispose()
+    await redis_client.aclose()
+
+
+def session_required(f):
+    @wraps(f)
+    async def decorated_function(request, *args, **kwargs):
+        session_id = request.headers.get("Session-Id")
+        user_id = int(request.headers.get("User-Id"))
+        if not session_id or not user_id:
+            return jsonify({"message": "Session-Id and User-Id required"}, 401)
+        result = await messenger_db.user.is_session_valid(user_id, session_id)
+        if not result:
+            return jsonify({"message": "Invalid session"}, 401)
+
+        return await f(request, *args, **kwargs)
+
+    return decorated_function
+
+
+def sent_by_others(request, messages, field):
+    """Whether any of `messages` names a sender other than the session's user."""
+    user_id = int(request.headers.get("User-Id"))
+    return any(m.get(field) != user_id for m in messages)
+
+
+async def store_public(messages, pipe):
+    if ingestor is not None:
+        return await ingestor.enqueue_public(messages, pipe)
+    return await messenger_db.public.send_messages(messages)
+
+
+async def store_private(messages, pipe):
+    if ingestor is not None:
+        return await ingestor.enqueue_private(messages, pipe)
+    return await messenger_db.private.send_messages(messages)
+
+
+async def notify(channel, row, name, pipe):
+    """Queue the notification of a stored message row, sent by `name`."""
+    # Compact, since the notification server forwards it to clients as is.
+    payload = json.dumps((*row, name), separators=(",", ":"))
+    await messenger_db.events.publish(channel, payload, pipe, tracing.current())
+
+
+async def publish(pipe):
+    """Run a pipeline that publishes notifications, timing the round trip."""
+    started = time.perf_counter()
+    await pipe.execute()
+    seconds = time.perf_counter() - started
+    metrics.REDIS_PUBLISH_SECONDS.observe(seconds)
+    tracing.record("redis_publish", seconds)
+
+
+async def read_page(read, data):
+    direction, query = page_query(data)
+    return jsonify(page_body(direction, query, await read(**query)))
+
+
+@app.get("/metrics")
+async def metrics_endpoint(request):
+    # Collectors may block on Redis, so the registry is rendered off the loop.
+    data, content_type = await asyncio.get_running_loop().run_in_executor(
+        None, metrics.render
+    )
+    return raw(data, content_type=content_type)
+
+
+@app.post("/api/user/is_session_valid")
+async def user_is_session_valid(request):
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        session_id = data.get("session_id")
+        result = await messenger_db.user.is_session_valid(user_id, session_id)
+        return jsonify({"success": result})
+    except Exception as e:
+        logger.debug(f"Error validating session: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/user/logout")
+@session_required
+async def user_logout(request):
+    try:
+        data = request.json
+        session_id = data.get("session_id")
+        result = await messenger_db.user.logout(session_id)
+        return jsonify({"success": result})
+    except Exception as e:
+        logger.debug(f"Error logging out: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/user/find_by_username")
+@session_required
+async def user_find_by_username(request):
+    try:
+        data = request.json
+        username = data.get("username")
+        limit = data.get("limit", 100)
+        offset = data.get("offset", 0)
+        mode = data.get("mode", "substring")
+        result = await messenger_db.user.find_by_username(username, limit, offset, mode)
+        return jsonify({"result": result})
+    except Exception as e:
+        logger.debug(f"Error finding user by username: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/user/login")
+async def user_login(request):
+    try:
+        data = request.json
+        username = data.get("username")
+        password = data.get("password")
+        session_id, user_id, name, email = await messenger_db.user.login(
+            username, password
+        )
+        return jsonify(
+            {
+                "success": True,
+                "session_id": session_id,
+                "user_id": user_id,
+                "name": name,
+                "email": email,
+            }
+        )
+    except Exception as e:
+        logger.debug(f"Error logging in: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/user/register")
+async def user_register(request):
+    try:
+        data = request.json
+        username = data.get("username")
+        name = data.get("name")
+        password = data.get("password")
+        if app.config.CHECK_SECURE_PASSWORD:
+            if not password_util.is_secure(password):
+                return jsonify({"success": False}, 500)
+
+        email = data.get("email")
+        emailinfo = validate_email(email, check_deliverability=False)
+        email = emailinfo.normalized
+
+        await messenger_db.user.register(username, name, password, email)
+        return jsonify({"success": True})
+    except SQLAlchemyError as e:
+        logger.debug(f"Database error: {e}")
+        return jsonify({"success": False}, 500)
+    except Exception as e:
+        logger.debug(f"Error registering user: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/user/find_by_user_id")
+@session_required
+async def user_find_by_user_id(request):
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        result = await messenger_db.user.find_by_user_id(user_id)
+        return jsonify(result)
+    except Exception as e:
+        logger.debug(f"Error finding user by ID: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/user/chat_list")
+@session_required
+async def user_chat_list(request):
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        limit = data.get("limit", 100)
+        offset = data.get("offset", 0)
+        result = await messenger_db.user.chat_list(user_id, limit, offset)
+        return jsonify(result)
+    except Exception as e:
+        logger.debug(f"Error getting chat list: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.put("/api/user/update")
+@session_required
+async def user_update(request):
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        username = data.get("username")
+        name = data.get("name")
+        password = data.get("password")
+        if app.config.CHECK_SECURE_PASSWORD:
+            if not password_util.is_secure(password):
+                return jsonify({"success": False}, 500)
+
+        email = data.get("email")
+        emailinfo = validate_email(email, check_deliverability=False)
+        email = emailinfo.normalized
+
+        await messenger_db.user.update(user_id, username, name, password, email)
+        return jsonify({"success": True})
+    except Exception as e:
+        logger.debug(f"Error updating user: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.delete("/api/user/delete")
+@session_required
+async def user_delete(request):
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        await messenger_db.user.delete(user_id)
+        return jsonify({"success": True})
+    except Exception as e:
+        logger.debug(f"Error deleting user: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/public/send_message")
+@session_required
+async def public_send_message(request):
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        message = data.get("message")
+        room_name = data.get("room_name", DEFAULT_ROOM)
+        pipe = redis_client.pipeline(transaction=False)
+        (row,) = await store_public([(user_id, message, room_name)], pipe)
+        # The stored name of the sender, not one sent by the client
+        name = (await messenger_db.user.names([user_id])).get(user_id)
+        await notify(room_channel(room_name), row, name, pipe)
+        await messenger_db.room_history.record(row, name, pipe)
+        await publish(pipe)
+        return jsonify({"success": True, "id": row[0]})
+    except Exception as e:
+        logger.debug(f"Error sending public message: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/public/send_messages")
+@session_required
+async def public_send_messages(request):
+    try:
+        messages = request.json.get("messages", [])
+        if len(messages) > app.config.MAX_BATCH_SIZE:
+            return jsonify({"success": False, "message": "Too many messages"}, 400)
+        if sent_by_others(request, messages, "user_id"):
+            return jsonify(
+                {
+                    "success": False,
+                    "message": "Messages must be sent by the session's user",
+                },
+                403,
+            )
+
+        pipe = redis_client.pipeline(transaction=False)
+        rows = await store_public(
+            [
+                (
+                    m.get("user_id"),
+                    m.get("message"),
+                    m.get("room_name", DEFAULT_ROOM),
+                )
+                for m in messages
+            ],
+            pipe,
+        )
+        # Every message is sent by the session's user
+        names = await messenger_db.user.names(sorted({row[1] for row in rows}))
+        for row in rows:
+            await notify(room_channel(row[3]), row, names.get(row[1]), pipe)
+            await messenger_db.room_history.record(row, names.get(row[1]), pipe)
+        await publish(pipe)
+        return jsonify({"success": True, "ids": [row[0] for row in rows]})
+    except Exception as e:
+        logger.debug(f"Error sending public messages: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/public/read_messages")
+@session_required
+async def public_read_messages(request):
+    try:
+        data = request.json
+        room_name = data.get("room_name", DEFAULT_ROOM)
+        if "cursor" in data or "direction" in data:
+            read = partial(messenger_db.public.read_page, room_name=room_name)
+            return await read_page(read, data)
+
+        limit = data.get("limit", 100)
+        offset = data.get("offset", 0)
+        timestamp = data.get("timestamp", "")
+        if timestamp == "":
+            timestamp = BEGINNING_OF_DATE
+        result = await messenger_db.public.read_messages(
+            limit, offset, timestamp, room_name
+        )
+        return jsonify({"messages": result})
+    except Exception as e:
+        logger.debug(f"Error reading public messages: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/private/send_message")
+@session_required
+async def private_send_message(request):
+    try:
+        data = request.json
+        sender_id = data.get("sender_id")
+        receiver_id = data.get("receiver_id")
+        message = data.get("message")
+        pipe = redis_client.pipeline(transaction=False)
+        (row,) = await store_private([(sender_id, receiver_id, message)], pipe)
+        # The stored name of the sender, not one sent by the client
+        name = (await messenger_db.user.names([sender_id])).get(sender_id)
+        await notify(user_channel(sender_id), row, "Me", pipe)
+        await notify(user_channel(receiver_id), row, name, pipe)
+        await messenger_db.chat_index.record(row, pipe)
+        await publish(pipe)
+        return jsonify({"success": True, "id": row[0]})
+    except Exception as e:
+        logger.debug(f"Error sending private message: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/private/send_messages")
+@session_required
+async def private_send_messages(request):
+    try:
+        messages = request.json.get("messages", [])
+        if len(messages) > app.config.MAX_BATCH_SIZE:
+            return jsonify({"success": False, "message": "Too many messages"}, 400)
+        if sent_by_others(request, messages, "sender_id"):
+            return jsonify(
+                {
+                    "success": False,
+                    "message": "Messages must be sent by the session's user",
+                },
+                403,
+            )
+
+        pipe = redis_client.pipeline(transaction=False)
+        rows = await store_private(
+            [
+                (m.get("sender_id"), m.get("receiver_id"), m.get("message"))
+                for m in messages
+            ],
+            pipe,
+        )
+        # Every message is sent by the session's user
+        names = await messenger_db.user.names(sorted({row[1] for row in rows}))
+        for row in rows:
+            await notify(user_channel(row[1]), row, "Me", pipe)
+            await notify(user_channel(row[2]), row, names.get(row[1]), pipe)
+            await messenger_db.chat_index.record(row, pipe)
+        await publish(pipe)
+        return jsonify({"success": True, "ids": [row[0] for row in rows]})
+    except Exception as e:
+        logger.debug(f"Error sending private messages: {e}")
+        return jsonify({"success": False}, 500)
+
+
+@app.post("/api/private/read_messages")
+@session_required
+async def private_read_messages(request):
+    try:
+        data = request.json
+        sender_id = data.get("sender_id")
+        receiver_id = data.get("receiver_id")
+        if "cursor" in data or "direction" in data:
+            read = partial(messenger_db.private.read_page, sender_id, receiver_id)
+            return await read_page(read, data)
+
+        limit = data.get("limit", 100)
+        offset = data.get("offset", 0)
+        timestamp = data.get("timestamp", "")
+        if timestamp == "":
+            timestamp = BEGINNING_OF_DATE
+        result = await messenger_db.private.read_messages(
+            sender_id, receiver_id, limit, offset, timestamp=timestamp
+        )
+        return jsonify({"messages": result})
+    except Exception as e:
+        logger.debug(f"Error reading private messages: {e}")
+        return jsonify({"success": False}, 500)
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=13247)
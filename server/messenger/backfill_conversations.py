@@ -0,0 +1,30 @@
+import argparse
+from flask import Flask
+from config import Config
+from messengerdb import db
+from messengerdb.messenger import PrivateManager
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill in the conversation id of existing private messages"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Number of rows updated per transaction",
+    )
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+
+    with app.app_context():
+        updated = PrivateManager(db.session).backfill_conversation_ids(args.batch_size)
+    print(f"Backfilled {updated} private messages")
+
+
+if __name__ == "__main__":
+    main()
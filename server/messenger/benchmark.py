@@ -0,0 +1,409 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from types import SimpleNamespace
+
+# Benchmarks run on local storage, in a database of their own, unless the
+# environment points them elsewhere.
+DEFAULT_DATABASE = os.path.join(
+    tempfile.gettempdir(), f"tchat-benchmark-{os.getpid()}.sqlite3"
+)
+os.environ.setdefault("STORAGE", "local")
+os.environ.setdefault("SQLITE_PATH", DEFAULT_DATABASE)
+
+from flask import Flask
+from config import Config
+from messengerdb import db, query_stats, Messenger
+from messengerdb.messenger import (
+    DEFAULT_ROOM,
+    TIME_FORMAT,
+    PrivateManager,
+    PublicManager,
+    UserManager,
+    UsernameTrigram,
+    Users,
+    insert_ignore_rows,
+    trigram_rows,
+)
+from messengerdb.storage import storage_for
+
+SYLLABLES = ["ka", "ri", "mo", "an", "el", "sa", "to", "ne", "li", "ba", "ro", "mi"]
+WORDS = (
+    "hello there how are you doing today see the new release tomorrow "
+    "meeting lunch coffee code review deploy fixed broken tests thanks "
+    "sounds good later tonight weekend photo link great idea"
+).split()
+
+BATCH_SIZE = 500
+PAGE_SIZE = 50
+OFFSETS = [0, 100, 1000, 10000]
+DEPTHS = [0, 100, 1000, 10000]
+BEGINNING_OF_DATE = datetime.datetime(1970, 1, 1)
+
+
+def zipf_weights(count, exponent=1.1):
+    """Weights of `count` items where a few are far more popular than the rest."""
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+
+def message_text(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(3, 25)))
+
+
+def spread_timestamps(count, days):
+    """`count` increasing timestamps over the last `days` days."""
+    start = datetime.datetime.now() - datetime.timedelta(days=days)
+    step = days * 86400 / max(count, 1)
+    return [
+        (start + datetime.timedelta(seconds=i * step)).strftime(TIME_FORMAT)
+        for i in range(count)
+    ]
+
+
+def seed(messenger, rng, users, public_messages, private_messages, conversations):
+    """Fill an empty database and return what the benchmarks look up.
+
+    Senders and conversation partners follow a Zipf distribution, so a few
+    users are in many conversations and a few conversations hold most of the
+    private messages.
+    """
+    session = db.session
+    user_ids = list(range(1, users + 1))
+    usernames = {}
+    rows = []
+    for user_id in user_ids:
+        name = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+        usernames[user_id] = f"{name}{user_id}"[:16]
+        rows.append(
+            {
+                "id": user_id,
+                "username": usernames[user_id],
+                "name": name.title(),
+                "password": hashlib.sha256(f"password-{user_id}".encode()).hexdigest(),
+                "email": f"{usernames[user_id]}@example.com",
+            }
+        )
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = rows[start : start + BATCH_SIZE]
+        insert_ignore_rows(session, Users, batch)
+        insert_ignore_rows(
+            session,
+            UsernameTrigram,
+            [
+                gram
+                for row in batch
+                for gram in trigram_rows(row["id"], row["username"])
+            ],
+        )
+    session.commit()
+
+    popularity = zipf_weights(users)
+    senders = rng.choices(user_ids, weights=popularity, k=public_messages)
+    timestamps = spread_timestamps(public_messages, days=365)
+    rows = [
+        (i + 1, sender_id, message_text(rng), DEFAULT_ROOM, timestamps[i])
+        for i, sender_id in enumerate(senders)
+    ]
+    for start in range(0, len(rows), BATCH_SIZE):
+        messenger.public.store_messages(rows[start : start + BATCH_SIZE])
+
+    pairs = set()
+    while len(pairs) < min(conversations, users * (users - 1) // 2):
+        a, b = rng.choices(user_ids, weights=popularity, k=2)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    pairs = sorted(pairs)
+    chosen = rng.choices(pairs, weights=zipf_weights(len(pairs)), k=private_messages)
+    timestamps = spread_timestamps(private_messages, days=365)
+    sizes = {}
+    rows = []
+    for i, pair in enumerate(chosen):
+        sender_id, receiver_id = pair if rng.random() < 0.5 else pair[::-1]
+        rows.append((i + 1, sender_id, receiver_id, message_text(rng), timestamps[i]))
+        sizes[pair] = sizes.get(pair, 0) + 1
+    for start in range(0, len(rows), BATCH_SIZE):
+        messenger.private.store_messages(rows[start : start + BATCH_SIZE])
+
+    chats = {}
+    for a, b in sizes:
+        chats[a] = chats.get(a, 0) + 1
+        chats[b] = chats.get(b, 0) + 1
+    return {
+        "usernames": usernames,
+        "public_messages": public_messages,
+        # Largest first
+        "conversations": sorted(sizes.items(), key=lambda item: -item[1]),
+        "chats": sorted(chats.items(), key=lambda item: -item[1]),
+        "private_ids": [row[0] for row in rows],
+        "private_pairs": chosen,
+    }
+
+
+def measure(name, params, call, repeat, warmup):
+    """Time `call` and count its SQL statements."""
+    for _ in range(warmup):
+        call()
+        db.session.remove()
+    timings = []
+    statements = 0
+    for _ in range(repeat):
+        stats = query_stats.start()
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+        query_stats.stop(name)
+        statements = stats.statements
+        db.session.remove()
+    timings.sort()
+    case = " ".join([name] + [f"{key}={value}" for key, value in params.items()])
+    return {
+        "case": case,
+        "name": name,
+        "params": params,
+        "iterations": repeat,
+        "min_ms": timings[0],
+        "median_ms": statistics.median(timings),
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        "mean_ms": statistics.fmean(timings),
+        "statements": statements,
+    }
+
+
+def cases(cached, uncached, data):
+    """`(name, params, call)` of every benchmark."""
+    usernames = data["usernames"]
+    top_user = data["chats"][0][0]
+    median_user = data["chats"][len(data["chats"]) // 2][0]
+    username = usernames[top_user]
+    sessions = {}
+
+    def login():
+        session_id, *_ = cached.user.login(username, f"password-{top_user}")
+        sessions[top_user] = session_id
+
+    yield "user.login", {}, login
+    login()
+    for label, managers in (("cached", cached), ("db", uncached)):
+        yield "user.is_session_valid", {"source": label}, (
+            lambda user=managers.user: user.is_session_valid(
+                top_user, sessions[top_user]
+            )
+        )
+
+    for label, query, mode in (
+        ("prefix", username[:2], "prefix"),
+        ("substring", username[1:4], "substring"),
+        ("exact", username, "substring"),
+    ):
+        yield "user.find_by_username", {"query": label}, partial(
+            cached.user.find_by_username, query, limit=10, mode=mode
+        )
+
+    for label, managers in (("index", cached), ("db", uncached)):
+        for chats, user_id in (("most", top_user), ("median", median_user)):
+            yield "user.chat_list", {"source": label, "user": chats}, partial(
+                managers.user.chat_list, user_id
+            )
+
+    for offset in OFFSETS:
+        if offset < data["public_messages"]:
+            yield "public.read_messages", {"offset": offset}, partial(
+                cached.public.read_messages,
+                PAGE_SIZE,
+                offset,
+                timestamp=BEGINNING_OF_DATE,
+            )
+    for label, managers in (("history", cached), ("db", uncached)):
+        for depth in DEPTHS:
+            # Deeper pages than the room history holds are read from MySQL.
+            in_history = depth + PAGE_SIZE <= cached.room_history.size
+            if depth < data["public_messages"] and (label == "db" or in_history):
+                before_id = data["public_messages"] + 1 - depth if depth else None
+                yield "public.read_page", {"source": label, "depth": depth}, partial(
+                    managers.public.read_page, PAGE_SIZE, before_id=before_id
+                )
+
+    conversations = data["conversations"]
+    for size, ((a, b), count) in (
+        ("largest", conversations[0]),
+        ("median", conversations[len(conversations) // 2]),
+        ("smallest", conversations[-1]),
+    ):
+        ids = [
+            message_id
+            for message_id, pair in zip(data["private_ids"], data["private_pairs"])
+            if pair == (a, b)
+        ]
+        for offset in OFFSETS:
+            if offset < count:
+                params = {"conversation": size, "offset": offset}
+                yield "private.read_messages", params, partial(
+                    cached.private.read_messages,
+                    a,
+                    b,
+                    PAGE_SIZE,
+                    offset,
+                    timestamp=BEGINNING_OF_DATE,
+                )
+        for depth in DEPTHS:
+            if depth < count:
+                params = {"conversation": size, "depth": depth}
+                before_id = ids[-depth] if depth else None
+                yield "private.read_page", params, partial(
+                    cached.private.read_page, a, b, PAGE_SIZE, before_id=before_id
+                )
+
+
+def git_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def compare(baseline_path, report, threshold):
+    """Print the change of every case against a previous report.
+
+    Returns the cases whose median grew by more than `threshold`.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    before = {result["case"]: result for result in baseline["results"]}
+    print(f"\nAgainst {baseline.get('commit') or baseline_path}:")
+    if baseline.get("settings") != report["settings"]:
+        print("The runs seeded different data, so their timings may not compare")
+    slower = []
+    for result in report["results"]:
+        old = before.get(result["case"])
+        if old is None:
+            continue
+        ratio = result["median_ms"] / old["median_ms"] if old["median_ms"] else 1.0
+        flag = ""
+        if ratio > threshold:
+            slower.append(result["case"])
+            flag = "  SLOWER"
+        print(
+            f"{old['median_ms']:9.3f} ms -> {result['median_ms']:9.3f} ms "
+            f"({ratio:5.2f}x)  {result['case']}{flag}"
+        )
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the messengerdb managers on seeded data"
+    )
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--public-messages", type=int, default=50000)
+    parser.add_argument("--private-messages", type=int, default=50000)
+    parser.add_argument("--conversations", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=50, help="timed calls per case")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--output", default="benchmark.json", help="JSON file for the results"
+    )
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="exit with an error if a median grew more than this factor",
+    )
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    storage = storage_for(app.config)
+    storage.prepare_schema()
+
+    try:
+        with app.app_context():
+            if db.session.query(Users.id).first() is not None:
+                sys.exit("The benchmark seeds its own data and needs an empty database")
+            # With the Redis caches, as the app runs, and with the database alone
+            cached = Messenger(app, storage.redis())
+            uncached = SimpleNamespace(
+                user=UserManager(db.session),
+                public=PublicManager(db.session),
+                private=PrivateManager(db.session),
+            )
+
+            started = time.perf_counter()
+            data = seed(
+                cached,
+                random.Random(args.seed),
+                args.users,
+                args.public_messages,
+                args.private_messages,
+                args.conversations,
+            )
+            print(f"Seeded in {time.perf_counter() - started:.1f} s")
+
+            results = []
+            for name, params, call in cases(cached, uncached, data):
+                result = measure(name, params, call, args.repeat, args.warmup)
+                results.append(result)
+                print(
+                    f"{result['median_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms  "
+                    f"{result['statements']:2d} statements  {result['case']}"
+                )
+            dialect = db.engine.dialect.name
+            conversations = data["conversations"]
+    finally:
+        if app.config["SQLALCHEMY_DATABASE_URI"].endswith(DEFAULT_DATABASE):
+            if os.path.exists(DEFAULT_DATABASE):
+                os.remove(DEFAULT_DATABASE)
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": app.config["STORAGE"],
+        "database": dialect,
+        "settings": {
+            "users": args.users,
+            "public_messages": args.public_messages,
+            "private_messages": args.private_messages,
+            "conversations": args.conversations,
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "page_size": PAGE_SIZE,
+        },
+        # Messages in the conversations that the private cases read
+        "conversation_sizes": {
+            "largest": conversations[0][1],
+            "median": conversations[len(conversations) // 2][1],
+            "smallest": conversations[-1][1],
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare and compare(args.compare, report, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
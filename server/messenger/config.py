@@ -0,0 +1,50 @@
+import os
+
+
+# Configuration
+class Config:
+    REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+    REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+    MYSQL_USER = os.getenv("MYSQL_USER")
+    MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
+    MYSQL_HOST = os.getenv("MYSQL_HOST")
+    MYSQL_DATABASE = os.getenv("MYSQL_DATABASE")
+    # "mysql" uses the MySQL and Redis services, "local" a SQLite file and an
+    # in-memory Redis, so that one process serves the API without services
+    STORAGE = os.getenv("STORAGE", "mysql")
+    SQLITE_PATH = os.path.abspath(os.getenv("SQLITE_PATH", "tchat.sqlite3"))
+    if STORAGE == "local":
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{SQLITE_PATH}"
+        ASYNC_DATABASE_URI = f"sqlite+aiosqlite:///{SQLITE_PATH}"
+    else:
+        SQLALCHEMY_DATABASE_URI = (
+            f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}"
+            f"@{MYSQL_HOST}/{MYSQL_DATABASE}"
+        )
+        # The same database through the asyncio driver, for `async_app.py`
+        ASYNC_DATABASE_URI = (
+            f"mysql+aiomysql://{MYSQL_USER}:{MYSQL_PASSWORD}"
+            f"@{MYSQL_HOST}/{MYSQL_DATABASE}"
+        )
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    CHECK_SECURE_PASSWORD = True
+    SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", 300))
+    SESSION_CACHE_LOCAL_TTL = float(os.getenv("SESSION_CACHE_LOCAL_TTL", 5))
+    SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+    # Newest messages per public room kept in Redis, and how often the list is
+    # reloaded from MySQL
+    ROOM_HISTORY_SIZE = int(os.getenv("ROOM_HISTORY_SIZE", 200))
+    ROOM_HISTORY_TTL = int(os.getenv("ROOM_HISTORY_TTL", 3600))
+    # Notifications kept per channel for replay, and for how long after the last
+    EVENT_LOG_LENGTH = int(os.getenv("EVENT_LOG_LENGTH", 1000))
+    EVENT_LOG_TTL = int(os.getenv("EVENT_LOG_TTL", 86400))
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 1000))
+    # "sync" commits messages before replying, "stream" writes them behind
+    INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+    # Opt-in query profiling, off with 0: statements slower than this are logged
+    # with their parameters and plan, and requests with more statements than
+    # MAX_REQUEST_STATEMENTS are logged with their most repeated ones
+    SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", 0))
+    MAX_REQUEST_STATEMENTS = int(os.getenv("MAX_REQUEST_STATEMENTS", 0))
+    # JSON-lines file that receives the spans of traced requests; empty is off
+    TRACE_LOG = os.getenv("TRACE_LOG", "")
@@ -0,0 +1,22 @@
+#!/bin/sh
+# Migrate the schema once, then start the workers.
+set -e
+
+python migrate.py
+
+# MESSENGER_SERVER picks the entry point: "gunicorn" runs the Flask app in
+# blocking workers, "sanic" runs the asyncio app in ASYNC_WORKERS event loops.
+case "${MESSENGER_SERVER:-gunicorn}" in
+    sanic)
+        # gunicorn.conf.py clears the metric files of a previous run itself.
+        if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+            rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+            mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+        fi
+        exec sanic async_app:app --host 0.0.0.0 --port 13247 \
+            --workers "${ASYNC_WORKERS:-1}"
+        ;;
+    *)
+        exec gunicorn -w 4 -b 0.0.0.0:13247 app:app
+        ;;
+esac
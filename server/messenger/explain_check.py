@@ -0,0 +1,26 @@
+import sys
+from flask import Flask
+from config import Config
+from messengerdb import db
+from messengerdb.explain import check_query_plans
+
+
+def main():
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+
+    with app.app_context():
+        problems = check_query_plans(db.engine)
+
+    for name, statement, plan in problems:
+        print(f"{name} scans a whole table:\n  {statement}")
+        for row in plan:
+            print(f"  {row}")
+    if problems:
+        sys.exit(1)
+    print("All manager queries are served by an index")
+
+
+if __name__ == "__main__":
+    main()
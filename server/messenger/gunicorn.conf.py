@@ -0,0 +1,17 @@
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+
+def on_starting(server):
+    # Metric files from a previous run would be summed into the new one.
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,44 @@
+import argparse
+import logging
+import socket
+from flask import Flask
+import redis
+from config import Config
+from messengerdb import db
+from messengerdb.ingest import IngestWorker
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drain messages written behind by the messenger into MySQL"
+    )
+    parser.add_argument(
+        "--consumer",
+        default=socket.gethostname(),
+        help="Stable consumer name; a restarted worker resumes its pending messages",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Maximum number of stream entries stored per transaction",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    redis_client = redis.StrictRedis(
+        host=app.config["REDIS_HOST"], port=app.config["REDIS_PORT"]
+    )
+
+    with app.app_context():
+        worker = IngestWorker(
+            redis_client, db.session, args.consumer, batch_size=args.batch_size
+        )
+        worker.run()
+
+
+if __name__ == "__main__":
+    main()
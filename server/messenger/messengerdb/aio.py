@@ -0,0 +1,492 @@
+import asyncio
+import json
+import logging
+from redis.exceptions import RedisError
+from beartype.typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .chat_index import PREVIEW_LENGTH, ChatIndex
+from .events import EventLog
+from .ingest import STREAM, ID_KEYS, MessageIngestor, max_ids, missing_users
+from .ingest import PRIVATE_TEXTS, PUBLIC_TEXTS, check_values
+from .ingest import private_rows, public_rows
+from .messenger import DEFAULT_ROOM, ConversationSwitch
+from .messenger import PrivateManager, PublicManager, UserManager
+from .metrics import SESSION_CACHE_INVALIDATIONS, SESSION_CACHE_LOOKUPS
+from .room_history import INGEST_STREAM, Page, RoomHistory
+from .session_cache import SessionCache
+
+logger = logging.getLogger(__name__)
+
+
+async def run_sync(sessions: Callable, call: Callable) -> Any:
+    """Run `call(session)`, written for a sync session, on a new async session.
+
+    SQLAlchemy runs the call in a greenlet whose I/O goes through the async
+    driver, so the managers' queries are reused without blocking the loop.
+    """
+    async with sessions() as session:
+        return await session.run_sync(call)
+
+
+class AsyncSessionCache(SessionCache):
+    """`SessionCache` on an asyncio Redis client."""
+
+    async def get(self, user_id: int, session_id: str) -> bool:
+        if self._recall(user_id, session_id):
+            return True
+
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(self.KEY_PREFIX + session_id)
+            except RedisError as e:
+                logger.debug(f"Session cache read failed: {e}")
+                cached = None
+            if cached is not None and int(cached) == user_id:
+                self._remember(user_id, session_id)
+                SESSION_CACHE_LOOKUPS.labels("redis_hit").inc()
+                return True
+
+        SESSION_CACHE_LOOKUPS.labels("miss").inc()
+        return False
+
+    async def add(self, user_id: int, session_id: str) -> None:
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                self._queue_add(pipe, user_id, session_id)
+                _, cached = await pipe.execute()
+            except RedisError as e:
+                logger.debug(f"Session cache write failed: {e}")
+                cached = None
+            if cached is not None and int(cached) != user_id:
+                # Invalidated while it was being checked
+                return
+        self._remember(user_id, session_id)
+
+    async def invalidate(self, session_ids: Iterable[str]) -> None:
+        session_ids = list(session_ids)
+        if not session_ids:
+            return
+        self._forget(session_ids)
+        SESSION_CACHE_INVALIDATIONS.inc(len(session_ids))
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                self._queue_invalidate(pipe, session_ids)
+                await pipe.execute()
+            except RedisError as e:
+                logger.debug(f"Session cache invalidation failed: {e}")
+
+    def _listen_for_invalidations(self) -> None:
+        # The listener needs a running loop; the server starts `listen` itself.
+        pass
+
+    async def listen(self) -> None:
+        """Apply invalidations broadcast by other workers until cancelled."""
+        while True:
+            try:
+                async with self.redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self.INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        self._forget(message["data"].decode("utf-8").split())
+            except RedisError as e:
+                # Invalidations may have been missed while disconnected.
+                logger.debug(f"Session invalidation listener failed: {e}")
+                with self._lock:
+                    self._local.clear()
+                await asyncio.sleep(1)
+
+
+class AsyncChatIndex(ChatIndex):
+    """`ChatIndex` on an asyncio Redis client."""
+
+    async def record(self, row: Tuple[int, int, int, str, str], pipe: Any) -> None:
+        """Queue the updates for a private message row on `pipe`."""
+        _, sender_id, receiver_id, message, timestamp = row
+        await self._queue(pipe, sender_id, receiver_id, message, timestamp)
+        await self._queue(pipe, receiver_id, sender_id, message, timestamp)
+
+    async def page(
+        self, user_id: int, limit: int, offset: int
+    ) -> Optional[List[Tuple[int, str, str]]]:
+        if limit <= 0:
+            return []
+        keys = self._keys(user_id)
+        try:
+            result = await self._page(keys=keys, args=[offset, offset + limit - 1])
+        except RedisError as e:
+            logger.debug(f"Chat index read failed: {e}")
+            return None
+        return self._entries(result)
+
+    async def rebuild(self, user_id: int, entries: List[Tuple[int, str, str]]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        for peer_id, message, timestamp in entries:
+            await self._queue(pipe, user_id, peer_id, message, timestamp)
+        pipe.set(self.BUILT_KEY.format(user_id), 1)
+        try:
+            await pipe.execute()
+        except RedisError as e:
+            logger.debug(f"Chat index rebuild failed: {e}")
+
+    async def forget(self, user_id: int) -> None:
+        try:
+            await self.redis.delete(*self._keys(user_id))
+        except RedisError as e:
+            logger.debug(f"Chat index removal failed: {e}")
+
+    async def _queue(
+        self, pipe: Any, user_id: int, peer_id: int, message: str, timestamp: str
+    ) -> None:
+        keys, args = self._upsert_args(user_id, peer_id, message, timestamp)
+        # Scripts of an asyncio client are coroutines even on a pipeline.
+        await self._upsert(keys=keys, args=args, client=pipe)
+
+
+class AsyncEventLog(EventLog):
+    """`EventLog` on an asyncio Redis client."""
+
+    async def publish(
+        self, channel: str, payload: str, pipe: Any, trace_id: Optional[str] = None
+    ) -> None:
+        keys, args = self._publish_args(channel, payload, trace_id)
+        await self._publish(keys=keys, args=args, client=pipe)
+
+
+class AsyncRoomHistory(RoomHistory):
+    """`RoomHistory` on an asyncio Redis client."""
+
+    async def record(
+        self, row: Tuple[int, int, str, str, str], name: Optional[str], pipe: Any
+    ) -> None:
+        keys, args = self._append_args(row, name)
+        await self._append(keys=keys, args=args, client=pipe)
+
+    async def page(
+        self,
+        room_name: str,
+        limit: int,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+    ) -> Tuple[Optional[Page], bool]:
+        try:
+            result = await self._page(
+                keys=self._keys(room_name),
+                args=self._page_args(limit, after_id, before_id),
+            )
+        except RedisError as e:
+            logger.debug(f"Room history read failed: {e}")
+            result = 0
+        return self._window(result)
+
+    async def queued(
+        self, room_name: str
+    ) -> Optional[List[Tuple[int, int, str, str, str]]]:
+        if self.ingest_stream is None:
+            return []
+        try:
+            entries = await self.redis.xrange(
+                self.ingest_stream, count=self.MAX_QUEUED + 1
+            )
+        except RedisError as e:
+            logger.debug(f"Room history queue read failed: {e}")
+            return None
+        return self._queued_rows(entries, room_name)
+
+    async def seed(
+        self,
+        room_name: str,
+        entries: List[Tuple[int, int, str, str, str]],
+        queued: List[Tuple[int, int, str, str, str]],
+    ) -> None:
+        try:
+            await self._seed(
+                keys=self._keys(room_name), args=self._seed_args(entries, queued)
+            )
+        except RedisError as e:
+            logger.debug(f"Room history seed failed: {e}")
+
+
+class AsyncMessageIngestor(MessageIngestor):
+    """`MessageIngestor` on an asyncio Redis client and async sessions."""
+
+    def __init__(self, redis_client: Any, sessions: Callable) -> None:
+        super().__init__(redis_client, None)
+        self.sessions = sessions
+
+    async def enqueue_public(
+        self, messages: List[Tuple[int, str, str]], pipe: Any
+    ) -> List[Tuple[int, int, str, str, str]]:
+        check_values(messages, users=1, columns=PUBLIC_TEXTS)
+        await self._check_users({user_id for user_id, _, _ in messages})
+        rows = public_rows(await self._next_ids("public", len(messages)), messages)
+        pipe.xadd(STREAM, {"kind": "public", "rows": json.dumps(rows)})
+        return rows
+
+    async def enqueue_private(
+        self, messages: List[Tuple[int, int, str]], pipe: Any
+    ) -> List[Tuple[int, int, int, str, str]]:
+        check_values(messages, users=2, columns=PRIVATE_TEXTS)
+        await self._check_users({user_id for m in messages for user_id in m[:2]})
+        rows = private_rows(await self._next_ids("private", len(messages)), messages)
+        pipe.xadd(STREAM, {"kind": "private", "rows": json.dumps(rows)})
+        return rows
+
+    async def _check_users(self, user_ids: Set[int]) -> None:
+        unknown = user_ids - self._known_users
+        if unknown:
+            missing = await run_sync(self.sessions, lambda s: missing_users(s, unknown))
+            self._remember_users(unknown, missing)
+
+    async def _next_ids(self, kind: str, count: int) -> List[int]:
+        if not self._seeded:
+            await self.seed_ids()
+        last = await self.redis.incrby(ID_KEYS[kind], count)
+        if self._counter_reset(kind, last, count):
+            await self.seed_ids()
+            last = await self.redis.incrby(ID_KEYS[kind], count)
+        return self._take_ids(kind, last, count)
+
+    async def seed_ids(self) -> None:
+        for kind, max_id in (await run_sync(self.sessions, max_ids)).items():
+            self._floor[kind] = max(self._floor[kind], max_id)
+            await self._seed(keys=[ID_KEYS[kind]], args=[self._floor[kind]])
+        self._seeded = True
+
+
+class AsyncUserManager:
+    def __init__(
+        self,
+        sessions: Callable,
+        session_cache: Optional[AsyncSessionCache] = None,
+        chat_index: Optional[AsyncChatIndex] = None,
+    ) -> None:
+        self.sessions = sessions
+        self.session_cache = session_cache
+        self.chat_index = chat_index
+
+    async def register(
+        self, username: str, name: str, password: str, email: str
+    ) -> None:
+        await run_sync(
+            self.sessions,
+            lambda s: UserManager(s).register(username, name, password, email),
+        )
+
+    async def login(
+        self, username: str, password: str
+    ) -> Optional[Tuple[str, int, str, str]]:
+        return await run_sync(
+            self.sessions, lambda s: UserManager(s).login(username, password)
+        )
+
+    async def is_session_valid(self, user_id: int, session_id: str) -> bool:
+        if self.session_cache is not None and await self.session_cache.get(
+            user_id, session_id
+        ):
+            return True
+
+        valid = await run_sync(
+            self.sessions,
+            lambda s: UserManager(s).is_session_valid(user_id, session_id),
+        )
+        if valid and self.session_cache is not None:
+            await self.session_cache.add(user_id, session_id)
+        return valid
+
+    async def logout(self, session_id: str) -> None:
+        await run_sync(self.sessions, lambda s: UserManager(s).logout(session_id))
+        if self.session_cache is not None:
+            await self.session_cache.invalidate([session_id])
+
+    async def find_by_username(self, *args, **kwargs) -> List[Tuple[int, str]]:
+        return await run_sync(
+            self.sessions,
+            lambda s: UserManager(s).find_by_username(*args, **kwargs),
+        )
+
+    async def names(self, user_ids: List[int]) -> Dict[int, str]:
+        return await run_sync(self.sessions, lambda s: UserManager(s).names(user_ids))
+
+    async def find_by_user_id(
+        self, user_id: int
+    ) -> Optional[Tuple[int, str, str, str]]:
+        return await run_sync(
+            self.sessions, lambda s: UserManager(s).find_by_user_id(user_id)
+        )
+
+    async def chat_list(
+        self, user_id: int, limit: int = 10, offset: int = 0
+    ) -> List[Tuple[int, str, str, str]]:
+        """Same entries as `UserManager.chat_list`."""
+        entries = None
+        if self.chat_index is not None:
+            entries = await self.chat_index.page(user_id, limit, offset)
+        if entries is None:
+            chats = await run_sync(
+                self.sessions, lambda s: UserManager(s).recent_chats(user_id)
+            )
+            if self.chat_index is not None:
+                await self.chat_index.rebuild(user_id, chats)
+            entries = [
+                (peer_id, message[:PREVIEW_LENGTH], timestamp)
+                for peer_id, message, timestamp in chats[offset : offset + limit]
+            ]
+
+        peer_ids = [peer_id for peer_id, _, _ in entries]
+        usernames = await run_sync(
+            self.sessions, lambda s: UserManager(s).usernames(peer_ids)
+        )
+        return [
+            (peer_id, usernames[peer_id], preview, timestamp)
+            for peer_id, preview, timestamp in entries
+            if peer_id in usernames
+        ]
+
+    async def update(
+        self, user_id: int, username: str, name: str, password: str, email: str
+    ) -> None:
+        await run_sync(
+            self.sessions,
+            lambda s: UserManager(s).update(user_id, username, name, password, email),
+        )
+
+    async def delete(self, user_id: int) -> None:
+        def delete(session) -> List[str]:
+            manager = UserManager(session)
+            session_ids = manager.session_ids(user_id)
+            manager.delete(user_id)
+            return session_ids
+
+        session_ids = await run_sync(self.sessions, delete)
+        if self.session_cache is not None:
+            await self.session_cache.invalidate(session_ids)
+        if self.chat_index is not None:
+            await self.chat_index.forget(user_id)
+
+
+class AsyncPublicManager:
+    def __init__(
+        self, sessions: Callable, room_history: Optional[AsyncRoomHistory] = None
+    ) -> None:
+        self.sessions = sessions
+        self.room_history = room_history
+
+    async def send_messages(
+        self, messages: List[Tuple[int, str, str]]
+    ) -> List[Tuple[int, int, str, str, str]]:
+        return await run_sync(
+            self.sessions, lambda s: PublicManager(s).send_messages(messages)
+        )
+
+    async def read_messages(self, *args, **kwargs) -> List[Tuple[int, str, str, str]]:
+        return await run_sync(
+            self.sessions, lambda s: PublicManager(s).read_messages(*args, **kwargs)
+        )
+
+    async def read_page(
+        self,
+        limit: int = 100,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+        room_name: str = DEFAULT_ROOM,
+    ) -> Page:
+        """Same pages as `PublicManager.read_page`."""
+        if self.room_history is not None:
+            page, seed = await self.room_history.page(
+                room_name, limit, after_id, before_id
+            )
+            if seed:
+                # Queued rows are read first: once stored, they leave the stream.
+                rows = await self.room_history.queued(room_name)
+                if rows is not None:
+                    size = self.room_history.size
+                    entries, queued = await run_sync(
+                        self.sessions,
+                        lambda s: (
+                            PublicManager(s).recent_messages(room_name, size),
+                            PublicManager(s).queued_messages(rows),
+                        ),
+                    )
+                    await self.room_history.seed(room_name, entries, queued)
+            if page is not None:
+                return page
+
+        return await run_sync(
+            self.sessions,
+            lambda s: PublicManager(s).read_page(limit, after_id, before_id, room_name),
+        )
+
+
+class AsyncPrivateManager:
+    def __init__(self, sessions: Callable) -> None:
+        self.sessions = sessions
+        self.conversations = ConversationSwitch()
+
+    def _manager(self, session) -> PrivateManager:
+        return PrivateManager(session, self.conversations)
+
+    async def send_messages(
+        self, messages: List[Tuple[int, int, str]]
+    ) -> List[Tuple[int, int, int, str, str]]:
+        return await run_sync(
+            self.sessions, lambda s: self._manager(s).send_messages(messages)
+        )
+
+    async def read_messages(
+        self, *args, **kwargs
+    ) -> List[Tuple[int, str, int, str, str, str]]:
+        return await run_sync(
+            self.sessions, lambda s: self._manager(s).read_messages(*args, **kwargs)
+        )
+
+    async def read_page(
+        self, *args, **kwargs
+    ) -> Tuple[List[Tuple[int, str, int, str, str, str]], Optional[int], Optional[int]]:
+        return await run_sync(
+            self.sessions, lambda s: self._manager(s).read_page(*args, **kwargs)
+        )
+
+
+class AsyncMessenger:
+    """`Messenger` for asyncio servers.
+
+    `sessions` is an `async_sessionmaker`; every call runs in its own session.
+    """
+
+    def __init__(
+        self, config: Dict[str, Any], sessions: Callable, redis_client: Any = None
+    ) -> None:
+        self.session_cache = AsyncSessionCache(
+            redis_client,
+            ttl=config.get("SESSION_CACHE_TTL", 300),
+            local_ttl=config.get("SESSION_CACHE_LOCAL_TTL", 5.0),
+            maxsize=config.get("SESSION_CACHE_SIZE", 10000),
+        )
+        self.chat_index = (
+            AsyncChatIndex(redis_client) if redis_client is not None else None
+        )
+        self.events = (
+            AsyncEventLog(
+                redis_client,
+                maxlen=config.get("EVENT_LOG_LENGTH", 1000),
+                ttl=config.get("EVENT_LOG_TTL", 86400),
+            )
+            if redis_client is not None
+            else None
+        )
+        self.room_history = (
+            AsyncRoomHistory(
+                redis_client,
+                size=config.get("ROOM_HISTORY_SIZE", 200),
+                ttl=config.get("ROOM_HISTORY_TTL", 3600),
+                ingest_stream=(
+                    INGEST_STREAM if config.get("INGEST_MODE") == "stream" else None
+                ),
+            )
+            if redis_client is not None
+            else None
+        )
+        self.user = AsyncUserManager(sessions, self.session_cache, self.chat_index)
+        self.public = AsyncPublicManager(sessions, self.room_history)
+        self.private = AsyncPrivateManager(sessions)
@@ -0,0 +1,139 @@
+import calendar
+import json
+import logging
+import time
+from redis.exceptions import RedisError
+from beartype.typing import Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+PREVIEW_LENGTH = 64
+
+# Move a peer to the front only if the message is not older than the one the
+# index already has; rebuilds can then race with new messages safely.
+UPSERT_SCRIPT = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if current and tonumber(current) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+return 1
+"""
+
+# Returns false when the index of the user was never built (or was lost).
+PAGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return false
+end
+local peers = redis.call('ZREVRANGE', KEYS[1], ARGV[1], ARGV[2])
+if #peers == 0 then
+    return {}
+end
+return {peers, redis.call('HMGET', KEYS[2], unpack(peers))}
+"""
+
+
+class ChatIndex:
+    """Recency-ordered list of each user's private conversations in Redis.
+
+    For every user, a sorted set maps peer ids to the time of the last
+    message exchanged with them and a hash holds a preview of that message. A
+    marker key records that the index of the user is complete; without it the
+    list is rebuilt from MySQL.
+    """
+
+    CHATS_KEY = "chats:{}"
+    PREVIEWS_KEY = "chat-previews:{}"
+    BUILT_KEY = "chats-built:{}"
+
+    def __init__(self, redis_client: Any) -> None:
+        self.redis = redis_client
+        self._upsert = redis_client.register_script(UPSERT_SCRIPT)
+        self._page = redis_client.register_script(PAGE_SCRIPT)
+
+    def record(self, row: Tuple[int, int, int, str, str], pipe: Any = None) -> None:
+        """Record a private message row on the lists of both users.
+
+        With `pipe`, the commands are queued on that pipeline and sent when
+        the caller executes it.
+        """
+        _, sender_id, receiver_id, message, timestamp = row
+        target = pipe if pipe is not None else self.redis.pipeline(transaction=False)
+        self._queue(target, sender_id, receiver_id, message, timestamp)
+        self._queue(target, receiver_id, sender_id, message, timestamp)
+        if pipe is None:
+            try:
+                target.execute()
+            except RedisError as e:
+                logger.debug(f"Chat index update failed: {e}")
+
+    def page(
+        self, user_id: int, limit: int, offset: int
+    ) -> Optional[List[Tuple[int, str, str]]]:
+        """Return `(peer_id, preview, timestamp)` entries, newest first.
+
+        Returns None when the index of the user is not available.
+        """
+        if limit <= 0:
+            # ZREVRANGE offset..offset-1 would be the whole index at offset 0.
+            return []
+        keys = self._keys(user_id)
+        try:
+            result = self._page(keys=keys, args=[offset, offset + limit - 1])
+        except RedisError as e:
+            logger.debug(f"Chat index read failed: {e}")
+            return None
+        return self._entries(result)
+
+    def _entries(self, result: Any) -> Optional[List[Tuple[int, str, str]]]:
+        if result is None:
+            return None
+        if not result:
+            return []
+        peers, previews = result
+        entries = []
+        for peer, preview in zip(peers, previews):
+            if preview is None:
+                continue
+            message, timestamp = json.loads(preview)
+            entries.append((int(peer), message, timestamp))
+        return entries
+
+    def rebuild(self, user_id: int, entries: List[Tuple[int, str, str]]) -> None:
+        """Load `(peer_id, message, timestamp)` entries read from MySQL."""
+        pipe = self.redis.pipeline(transaction=False)
+        for peer_id, message, timestamp in entries:
+            self._queue(pipe, user_id, peer_id, message, timestamp)
+        pipe.set(self.BUILT_KEY.format(user_id), 1)
+        try:
+            pipe.execute()
+        except RedisError as e:
+            logger.debug(f"Chat index rebuild failed: {e}")
+
+    def forget(self, user_id: int) -> None:
+        try:
+            self.redis.delete(*self._keys(user_id))
+        except RedisError as e:
+            logger.debug(f"Chat index removal failed: {e}")
+
+    def _keys(self, user_id: int) -> List[str]:
+        return [
+            self.CHATS_KEY.format(user_id),
+            self.PREVIEWS_KEY.format(user_id),
+            self.BUILT_KEY.format(user_id),
+        ]
+
+    def _queue(
+        self, pipe: Any, user_id: int, peer_id: int, message: str, timestamp: str
+    ) -> None:
+        keys, args = self._upsert_args(user_id, peer_id, message, timestamp)
+        self._upsert(keys=keys, args=args, client=pipe)
+
+    def _upsert_args(
+        self, user_id: int, peer_id: int, message: str, timestamp: str
+    ) -> Tuple[List[str], List[Any]]:
+        score = calendar.timegm(time.strptime(timestamp, TIME_FORMAT))
+        preview = json.dumps((message[:PREVIEW_LENGTH], timestamp))
+        return self._keys(user_id)[:2], [peer_id, score, preview]
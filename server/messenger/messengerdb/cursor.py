@@ -0,0 +1,62 @@
+import base64
+from beartype.typing import Any, Dict, List, Optional, Tuple
+
+FORWARD = "forward"
+BACKWARD = "backward"
+DIRECTIONS = (FORWARD, BACKWARD)
+
+
+def encode_cursor(message_id: int, direction: str) -> str:
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Unknown direction: {direction}")
+    raw = f"{direction[0]}:{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        prefix, message_id = base64.urlsafe_b64decode(padded).decode().split(":")
+        direction = {"f": FORWARD, "b": BACKWARD}[prefix]
+        return int(message_id), direction
+    except (ValueError, KeyError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def page_query(data: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Turn a paged read request into its direction and `read_page` arguments.
+
+    The request carries either an opaque `cursor` from a previous page or a
+    starting `direction`: "backward" starts from the newest message and
+    "forward" from the oldest one.
+    """
+    limit = data.get("limit", 100)
+    cursor = data.get("cursor")
+    if cursor:
+        message_id, direction = decode_cursor(cursor)
+    else:
+        message_id, direction = None, data.get("direction", BACKWARD)
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Unknown direction: {direction}")
+
+    if direction == FORWARD:
+        return direction, {"limit": limit, "after_id": message_id or 0}
+    return direction, {"limit": limit, "before_id": message_id}
+
+
+def page_body(
+    direction: str,
+    query: Dict[str, Any],
+    page: Tuple[List[Any], Optional[int], Optional[int]],
+) -> Dict[str, Any]:
+    """The JSON body for a page returned by `read_page(**query)`."""
+    rows, first_id, last_id = page
+    if direction == FORWARD:
+        # Forward paging never runs out: the last cursor polls for new messages.
+        next_cursor = encode_cursor(last_id or query["after_id"], FORWARD)
+        prev_cursor = encode_cursor(first_id, BACKWARD) if rows else None
+    else:
+        full = len(rows) == query["limit"]
+        next_cursor = encode_cursor(first_id, BACKWARD) if full else None
+        prev_cursor = encode_cursor(last_id, FORWARD) if rows else None
+    return {"messages": rows, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
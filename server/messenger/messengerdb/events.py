@@ -0,0 +1,52 @@
+from beartype.typing import Any, List, Optional, Tuple
+
+# Append the payload to the event log of a channel and publish it with the id
+# of the entry, so subscribers can tell which entries they have seen, and the
+# trace id of the request that sent it.
+PUBLISH_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'data', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', ARGV[4], id .. ' ' .. ARGV[5] .. ' ' .. ARGV[3])
+return id
+"""
+
+
+def room_channel(room_name: str) -> str:
+    """Channel of the messages of a public room."""
+    return f"room-{room_name}"
+
+
+def user_channel(user_id: int) -> str:
+    """Channel of the private messages sent to or by a user."""
+    return f"user-{user_id}"
+
+
+class EventLog:
+    """Notifications of each channel, published and kept in a Redis stream.
+
+    Pub/sub messages are `"<entry id> <trace id> <payload>"`, with `-` for
+    messages sent outside of a traced request. The stream of a channel keeps
+    about `maxlen` entries and expires `ttl` seconds after its last one, so the
+    notification server can replay what a reconnecting client missed.
+    """
+
+    STREAM_KEY = "events:{}"
+
+    def __init__(self, redis_client: Any, maxlen: int = 1000, ttl: int = 86400) -> None:
+        self.redis = redis_client
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self._publish = redis_client.register_script(PUBLISH_SCRIPT)
+
+    def publish(
+        self, channel: str, payload: str, pipe: Any, trace_id: Optional[str] = None
+    ) -> None:
+        """Queue the notification on `pipe`."""
+        keys, args = self._publish_args(channel, payload, trace_id)
+        self._publish(keys=keys, args=args, client=pipe)
+
+    def _publish_args(
+        self, channel: str, payload: str, trace_id: Optional[str]
+    ) -> Tuple[List[str], List[Any]]:
+        key = self.STREAM_KEY.format(channel)
+        return [key], [self.maxlen, self.ttl, payload, channel, trace_id or "-"]
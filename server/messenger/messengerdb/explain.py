@@ -0,0 +1,223 @@
+import datetime
+import logging
+import random
+from contextlib import contextmanager
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session as OrmSession
+from beartype.typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+
+from .messenger import (
+    DEFAULT_ROOM,
+    PrivateManager,
+    PublicManager,
+    PublicRoomMessages,
+    Session,
+    UserChat,
+    UserManager,
+    UsernameTrigram,
+    Users,
+    conversation_key,
+    trigram_rows,
+)
+
+logger = logging.getLogger(__name__)
+
+# Access types that read a whole table or a whole index.
+FULL_SCAN_TYPES = {"ALL", "index"}
+
+# Statements whose plan depends on an index; plain inserts are not explained.
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+# (case, table) pairs of scans that are intended, such as a lookup in a table
+# that always stays small; every other scan of a base table fails the check.
+ALLOWED_FULL_SCANS: Set[Tuple[str, str]] = {
+    # Queries without a trigram walk the username index until a page is full
+    ("UserManager.find_by_username(short)", "Users"),
+}
+
+# Rows written before the plans are checked, so that the optimizer does not
+# pick a scan only because the tables are nearly empty.
+SEED_USERS = 2000
+SEED_MESSAGES = 20000
+SEED_ROOMS = 20
+
+# (name, call) pairs covering every query issued by the managers. The
+# arguments only need to be well formed: EXPLAIN does not need matching rows.
+CASES: List[Tuple[str, Callable]] = [
+    ("UserManager.login", lambda m: m.user.login("explain", "explain")),
+    ("UserManager.is_session_valid", lambda m: m.user.is_session_valid(1, "0" * 32)),
+    ("UserManager.logout", lambda m: m.user.logout("0" * 32)),
+    ("UserManager.find_by_username", lambda m: m.user.find_by_username("explain")),
+    ("UserManager.find_by_username(short)", lambda m: m.user.find_by_username("ex")),
+    (
+        "UserManager.find_by_username(prefix)",
+        lambda m: m.user.find_by_username("ex", mode="prefix"),
+    ),
+    ("UserManager.find_by_user_id", lambda m: m.user.find_by_user_id(1)),
+    ("UserManager.chat_list", lambda m: m.user.chat_list(1)),
+    ("UserManager.update", lambda m: m.user.update(1, "u", "n", "p", "e")),
+    ("UserManager.delete", lambda m: m.user.delete(m.spare_user_id)),
+    ("PublicManager.read_messages", lambda m: m.public.read_messages()),
+    ("PublicManager.read_page", lambda m: m.public.read_page(before_id=1000)),
+    (
+        "PublicManager.recent_messages",
+        lambda m: m.public.recent_messages("public_room", 200),
+    ),
+    ("PrivateManager.read_messages", lambda m: m.private.read_messages(1, 2)),
+    ("PrivateManager.read_page", lambda m: m.private.read_page(1, 2, after_id=10)),
+]
+
+
+class Managers:
+    def __init__(self, session, spare_user_id: int) -> None:
+        self.user = UserManager(session)
+        self.public = PublicManager(session)
+        self.private = PrivateManager(session)
+        # A seeded user without sessions or messages, which can be deleted
+        self.spare_user_id = spare_user_id
+
+
+def explain_statement(
+    connection, statement: str, parameters: Any
+) -> List[Dict[str, Any]]:
+    """Run MySQL's EXPLAIN for a statement as sent to the driver."""
+    result = connection.exec_driver_sql("EXPLAIN " + statement, parameters)
+    return [dict(row._mapping) for row in result]
+
+
+def full_scans(plan: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Derived tables such as `<union2,3>` are scanned by design. A base table
+    # counts even when it has a usable index, since a skipped index is exactly
+    # what a wrong column order or a function on a column leads to.
+    return [
+        row
+        for row in plan
+        if row.get("type") in FULL_SCAN_TYPES
+        and not str(row.get("table", "")).startswith("<")
+    ]
+
+
+def seed_rows(connection) -> int:
+    """Write users, sessions and messages in the open transaction of `connection`.
+
+    Their ids follow the existing ones, so a database with data can be checked.
+    Returns the id of the last user, which has no sessions or messages.
+    """
+    rng = random.Random(0)
+    first_id = (connection.execute(select(func.max(Users.id))).scalar() or 0) + 1
+    spare_user_id = first_id + SEED_USERS
+    user_ids = list(range(first_id, spare_user_id))
+    users = [
+        {
+            "id": user_id,
+            "username": f"seed-{user_id}",
+            "name": "Seed",
+            "password": "0" * 64,
+            "email": f"seed-{user_id}@explain.invalid",
+        }
+        for user_id in [*user_ids, spare_user_id]
+    ]
+    connection.execute(insert(Users), users)
+    connection.execute(
+        insert(UsernameTrigram),
+        [gram for user in users for gram in trigram_rows(user["id"], user["username"])],
+    )
+    connection.execute(
+        insert(Session),
+        [
+            {"session_id": f"{user_id:032x}"[-32:], "user_id": user_id}
+            for user_id in user_ids
+        ],
+    )
+
+    start = datetime.datetime.now() - datetime.timedelta(days=30)
+    timestamps = [start + datetime.timedelta(minutes=i) for i in range(SEED_MESSAGES)]
+    rooms = [DEFAULT_ROOM] + [f"seed-room-{i}" for i in range(1, SEED_ROOMS)]
+    connection.execute(
+        insert(PublicRoomMessages),
+        [
+            {
+                "user_id": rng.choice(user_ids),
+                "message": "seed",
+                "room_name": rng.choice(rooms),
+                "timestamp": timestamp,
+            }
+            for timestamp in timestamps
+        ],
+    )
+    private = []
+    for timestamp in timestamps:
+        sender_id, receiver_id = rng.sample(user_ids, 2)
+        private.append(
+            {
+                "sender_id": sender_id,
+                "receiver_id": receiver_id,
+                "conversation_id": conversation_key(sender_id, receiver_id),
+                "message": "seed",
+                "timestamp": timestamp,
+            }
+        )
+    connection.execute(insert(UserChat), private)
+    return spare_user_id
+
+
+@contextmanager
+def captured_statements(connection) -> Iterator[List[Tuple[str, Any]]]:
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(EXPLAINABLE):
+            statements.append((statement, parameters))
+
+    event.listen(connection, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(connection, "before_cursor_execute", capture)
+
+
+def check_query_plans(engine) -> List[Tuple[str, str, List[Dict[str, Any]]]]:
+    """EXPLAIN every manager query and return the ones that scan a table.
+
+    The seed rows and the writes of every case stay inside a transaction that
+    is rolled back at the end, so they never reach the database. Each case
+    also runs in a savepoint of its own, so it sees the seed rows unchanged.
+    A case whose call fails, for example on a constraint, still has the
+    statements it sent up to the failure explained.
+    """
+    if engine.dialect.name != "mysql":
+        raise RuntimeError("Query plans can only be checked on MySQL")
+
+    problems = []
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            spare_user_id = seed_rows(connection)
+            for name, call in CASES:
+                case = connection.begin_nested()
+                session = OrmSession(
+                    bind=connection, join_transaction_mode="create_savepoint"
+                )
+                try:
+                    with captured_statements(connection) as statements:
+                        try:
+                            call(Managers(session, spare_user_id))
+                        except DBAPIError as e:
+                            logger.warning(f"{name} failed, explaining it anyway: {e}")
+                            session.rollback()
+                    for statement, parameters in statements:
+                        plan = explain_statement(connection, statement, parameters)
+                        scans = [
+                            row
+                            for row in full_scans(plan)
+                            if (name, row.get("table")) not in ALLOWED_FULL_SCANS
+                        ]
+                        if scans:
+                            problems.append((name, statement, plan))
+                finally:
+                    session.close()
+                    case.rollback()
+        finally:
+            transaction.rollback()
+    return problems
@@ -0,0 +1,381 @@
+import json
+import logging
+import time
+from redis.exceptions import RedisError, ResponseError
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import func
+from sqlalchemy.exc import DataError, IntegrityError
+from beartype.typing import Any, Dict, Iterable, List, Set, Tuple
+
+from .room_history import INGEST_STREAM
+from .messenger import (
+    CURRENT_TIMESTAMP,
+    TIME_FORMAT,
+    PrivateManager,
+    PublicManager,
+    PublicRoomMessages,
+    UserChat,
+    Users,
+)
+
+logger = logging.getLogger(__name__)
+
+STREAM = INGEST_STREAM
+GROUP = "ingest-writers"
+# Entries whose rows could not be stored, with the reason, for an operator
+FAILED_STREAM = "ingest:failed"
+ID_KEYS = {
+    "public": "ids:PublicRoomMessages",
+    "private": "ids:UserChats",
+}
+MODELS = {"public": PublicRoomMessages, "private": UserChat}
+# Columns of the text fields of the queued messages, in their order
+PUBLIC_TEXTS = [PublicRoomMessages.message, PublicRoomMessages.room_name]
+PRIVATE_TEXTS = [UserChat.message]
+# Bytes of a MySQL TEXT column
+TEXT_BYTES = 65535
+# Errors caused by the rows of an entry rather than by the database; other
+# errors stop the worker, which replays the entry once it is restarted.
+ROW_ERRORS = (IntegrityError, DataError)
+
+# Raise an id counter to at least ARGV[1]; it never moves backwards.
+SEED_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class MessageIngestor:
+    """Write-behind path for new messages.
+
+    Ids are handed out by Redis counters kept ahead of the MySQL tables, and
+    the rows are appended to a Redis stream in the same pipeline as their
+    notifications. `IngestWorker` later drains the stream into MySQL. Rows are
+    checked before they are queued, since the client is told they are stored.
+    """
+
+    def __init__(self, redis_client: Any, session) -> None:
+        self.redis = redis_client
+        self.session = session
+        self._seed = redis_client.register_script(SEED_SCRIPT)
+        self._seeded = False
+        # The largest id of each kind known to be taken, in MySQL or by this
+        # process; a counter that hands out ids at or below it was reset.
+        self._floor = {kind: 0 for kind in ID_KEYS}
+        # Users known to exist; a user deleted since is caught by the worker.
+        self._known_users: Set[int] = set()
+
+    def enqueue_public(
+        self, messages: List[Tuple[int, str, str]], pipe: Any
+    ) -> List[Tuple[int, int, str, str, str]]:
+        """Queue `(user_id, message, room_name)` triples on `pipe`."""
+        check_values(messages, users=1, columns=PUBLIC_TEXTS)
+        self._check_users({user_id for user_id, _, _ in messages})
+        rows = public_rows(self._next_ids("public", len(messages)), messages)
+        pipe.xadd(STREAM, {"kind": "public", "rows": json.dumps(rows)})
+        return rows
+
+    def enqueue_private(
+        self, messages: List[Tuple[int, int, str]], pipe: Any
+    ) -> List[Tuple[int, int, int, str, str]]:
+        """Queue `(sender_id, receiver_id, message)` triples on `pipe`."""
+        check_values(messages, users=2, columns=PRIVATE_TEXTS)
+        self._check_users({user_id for m in messages for user_id in m[:2]})
+        rows = private_rows(self._next_ids("private", len(messages)), messages)
+        pipe.xadd(STREAM, {"kind": "private", "rows": json.dumps(rows)})
+        return rows
+
+    def _check_users(self, user_ids: Set[int]) -> None:
+        unknown = user_ids - self._known_users
+        if unknown:
+            self._remember_users(unknown, missing_users(self.session, unknown))
+
+    def _remember_users(self, user_ids: Set[int], missing: Set[int]) -> None:
+        if missing:
+            raise ValueError(f"Unknown users: {sorted(missing)}")
+        self._known_users |= user_ids
+
+    def _next_ids(self, kind: str, count: int) -> List[int]:
+        if not self._seeded:
+            self.seed_ids()
+        last = self.redis.incrby(ID_KEYS[kind], count)
+        if self._counter_reset(kind, last, count):
+            self.seed_ids()
+            last = self.redis.incrby(ID_KEYS[kind], count)
+        return self._take_ids(kind, last, count)
+
+    def _counter_reset(self, kind: str, last: int, count: int) -> bool:
+        if last - count < self._floor[kind]:
+            logger.warning(
+                f"The {kind} id counter went back to {last}; seeding it again"
+            )
+            return True
+        return False
+
+    def _take_ids(self, kind: str, last: int, count: int) -> List[int]:
+        if last - count < self._floor[kind]:
+            raise RuntimeError(f"The {kind} id counter is behind the stored ids")
+        self._floor[kind] = last
+        return list(range(last - count + 1, last + 1))
+
+    def seed_ids(self) -> None:
+        """Move the id counters past the ids already used in MySQL."""
+        for kind, max_id in max_ids(self.session).items():
+            self._floor[kind] = max(self._floor[kind], max_id)
+            self._seed(keys=[ID_KEYS[kind]], args=[self._floor[kind]])
+        self._seeded = True
+
+
+def check_values(messages: Iterable[Tuple], users: int, columns: List[Any]) -> None:
+    """Check the values of messages before they are queued.
+
+    The first `users` fields of each message must be user ids, and the fields
+    after them strings that fit in `columns`, so that MySQL accepts them.
+    """
+    for message in messages:
+        user_ids, texts = message[:users], message[users : users + len(columns)]
+        if not all(type(user_id) is int for user_id in user_ids):
+            raise ValueError(f"Invalid user id in {message[:users]!r}")
+        for text, column in zip(texts, columns):
+            if not isinstance(text, str) or not fits(text, column):
+                raise ValueError(f"Invalid {column.name} for user {message[0]}")
+
+
+def fits(text: str, column: Any) -> bool:
+    if column.type.length is None:
+        return len(text.encode("utf-8")) <= TEXT_BYTES
+    return len(text) <= column.type.length
+
+
+def missing_users(session, user_ids: Set[int]) -> Set[int]:
+    found = {
+        user_id for (user_id,) in session.query(Users.id).filter(Users.id.in_(user_ids))
+    }
+    session.commit()
+    return user_ids - found
+
+
+def public_rows(
+    ids: List[int], messages: List[Tuple[int, str, str]]
+) -> List[Tuple[int, int, str, str, str]]:
+    timestamp = CURRENT_TIMESTAMP().strftime(TIME_FORMAT)
+    return [
+        (message_id, user_id, message, room_name, timestamp)
+        for message_id, (user_id, message, room_name) in zip(ids, messages)
+    ]
+
+
+def private_rows(
+    ids: List[int], messages: List[Tuple[int, int, str]]
+) -> List[Tuple[int, int, int, str, str]]:
+    timestamp = CURRENT_TIMESTAMP().strftime(TIME_FORMAT)
+    return [
+        (message_id, sender_id, receiver_id, message, timestamp)
+        for message_id, (sender_id, receiver_id, message) in zip(ids, messages)
+    ]
+
+
+def max_ids(session) -> Dict[str, int]:
+    """The largest id stored in MySQL for each kind of message."""
+    ids = {
+        kind: session.query(func.max(model.id)).scalar() or 0
+        for kind, model in MODELS.items()
+    }
+    session.commit()
+    return ids
+
+
+class IngestWorker:
+    """Drain the ingestion stream into MySQL in batched transactions.
+
+    Entries are acknowledged and deleted only after their rows are committed.
+    After a crash, the entries still pending for this consumer (or left idle
+    by another one) are read again. When a batch fails, its entries are
+    stored one by one: rows that are already stored with the same values were
+    committed before the crash and are skipped. Rows whose id holds another
+    message, and entries that break a constraint or hold values MySQL rejects,
+    are moved to `FAILED_STREAM` and logged, so nothing is dropped silently or
+    stored twice, and one bad entry cannot stop ingestion.
+    """
+
+    def __init__(
+        self,
+        redis_client: Any,
+        session,
+        consumer: str,
+        batch_size: int = 500,
+        block_ms: int = 1000,
+        claim_idle_ms: int = 60000,
+    ) -> None:
+        self.redis = redis_client
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.session = session
+        self.managers = {
+            "public": PublicManager(session),
+            "private": PrivateManager(session),
+        }
+
+    def ensure_group(self) -> None:
+        try:
+            self.redis.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def run(self) -> None:
+        self.ensure_group()
+        # Entries delivered to this consumer before a restart come first.
+        while self.drain(pending=True):
+            pass
+        while True:
+            self.claim_stale()
+            self.drain()
+
+    def drain(self, pending: bool = False) -> int:
+        response = self.redis.xreadgroup(
+            GROUP,
+            self.consumer,
+            {STREAM: "0" if pending else ">"},
+            count=self.batch_size,
+            block=None if pending else self.block_ms,
+        )
+        entries = response[0][1] if response else []
+        return self.store(entries)
+
+    def claim_stale(self) -> int:
+        """Take over entries another consumer left unacknowledged."""
+        response = self.redis.xautoclaim(
+            STREAM,
+            GROUP,
+            self.consumer,
+            self.claim_idle_ms,
+            count=self.batch_size,
+        )
+        return self.store(response[1])
+
+    def store(self, entries: List[Tuple[Any, Any]]) -> int:
+        if not entries:
+            return 0
+        batches = []
+        for entry_id, fields in entries:
+            if not fields:
+                # Deleted while still pending; acknowledging it is enough.
+                continue
+            rows = [tuple(row) for row in json.loads(fields[b"rows"])]
+            batches.append((entry_id, fields[b"kind"].decode(), rows))
+        try:
+            for kind in self.managers:
+                self.managers[kind].store_messages(
+                    [
+                        row
+                        for _, batch_kind, rows in batches
+                        if batch_kind == kind
+                        for row in rows
+                    ]
+                )
+        except ROW_ERRORS as e:
+            self.session.rollback()
+            logger.debug(f"Storing {len(batches)} entries one by one: {e.orig}")
+            for batch in batches:
+                self.store_entry(*batch)
+
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.xack(STREAM, GROUP, *entry_ids)
+        pipe.xdel(STREAM, *entry_ids)
+        pipe.execute()
+        logger.debug(f"Stored {sum(len(rows) for _, _, rows in batches)} messages")
+        return len(entries)
+
+    def store_entry(self, entry_id: Any, kind: str, rows: List[Tuple]) -> None:
+        stored = stored_rows(self.session, kind, [row[0] for row in rows])
+        new = [row for row in rows if row[0] not in stored]
+        taken = [row for row in rows if row[0] in stored and stored[row[0]] != row]
+        try:
+            self.managers[kind].store_messages(new)
+        except ROW_ERRORS as e:
+            self.session.rollback()
+            self.fail(entry_id, kind, new + taken, str(e.orig))
+            return
+        if taken:
+            self.fail(entry_id, kind, taken, "id already holds another message")
+
+    def fail(self, entry_id: Any, kind: str, rows: List[Tuple], error: str) -> None:
+        logger.error(
+            f"Could not store {len(rows)} {kind} messages of entry "
+            f"{entry_id.decode()}: {error}"
+        )
+        self.redis.xadd(
+            FAILED_STREAM,
+            {
+                "entry": entry_id,
+                "kind": kind,
+                "rows": json.dumps(rows),
+                "error": error,
+            },
+        )
+
+
+def stored_rows(session, kind: str, ids: List[int]) -> Dict[int, Tuple]:
+    """The stored rows with these ids, in the `send_message` format."""
+    model = MODELS[kind]
+    rows = {
+        message.id: message.to_tuple()
+        for message in session.query(model).filter(model.id.in_(ids))
+    }
+    session.commit()
+    return rows
+
+
+class IngestLagCollector:
+    """Report the backlog of the ingestion stream when metrics are scraped.
+
+    Stored entries are deleted from the stream, so its first entry is the
+    oldest message not yet in MySQL.
+    """
+
+    def __init__(self, redis_client: Any) -> None:
+        self.redis = redis_client
+
+    def describe(self):
+        # Keeps the registry from querying Redis when the collector is added.
+        return []
+
+    def collect(self):
+        backlog = GaugeMetricFamily(
+            "messenger_ingest_backlog",
+            "Batches in the ingestion stream that are not in MySQL yet",
+        )
+        lag = GaugeMetricFamily(
+            "messenger_ingest_lag_seconds",
+            "Age of the oldest batch that is not in MySQL yet",
+        )
+        failed = GaugeMetricFamily(
+            "messenger_ingest_failed",
+            "Batches moved aside because some of their rows could not be stored",
+        )
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.xlen(STREAM)
+            pipe.xrange(STREAM, count=1)
+            pipe.xlen(FAILED_STREAM)
+            length, oldest, failed_length = pipe.execute()
+        except RedisError as e:
+            logger.debug(f"Ingestion lag unavailable: {e}")
+            return
+        backlog.add_metric([], length)
+        if oldest:
+            created_ms = int(oldest[0][0].split(b"-")[0])
+            lag.add_metric([], max(0.0, time.time() - created_ms / 1000))
+        else:
+            lag.add_metric([], 0.0)
+        failed.add_metric([], failed_length)
+        yield backlog
+        yield lag
+        yield failed
@@ -2,9 +2,16 @@ from flask_sqlalchemy import SQLAlchemy
 import hashlib
 import secrets
 import datetime
+import time
+from sqlalchemy import case, func, insert, select
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm.exc import NoResultFound
-from beartype.typing import List, Tuple, Optional
+from beartype.typing import Any, Dict, List, Tuple, Optional
+
+from .chat_index import PREVIEW_LENGTH, ChatIndex
+from .events import EventLog
+from .room_history import INGEST_STREAM, Page, RoomHistory
+from .session_cache import SessionCache
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
@@ -13,6 +20,98 @@ db = SQLAlchemy()
 
 CURRENT_TIMESTAMP = lambda: datetime.datetime.now(datetime.timezone.utc)
 
+# Seconds between checks for rows that still lack a conversation id
+CONVERSATION_CHECK_INTERVAL = 60
+
+# The room of the client's public chat
+DEFAULT_ROOM = "public_room"
+
+# Modes of `UserManager.find_by_username`
+SEARCH_PREFIX = "prefix"
+SEARCH_SUBSTRING = "substring"
+SEARCH_MODES = (SEARCH_PREFIX, SEARCH_SUBSTRING)
+
+
+def conversation_key(user_a: int, user_b: int) -> int:
+    """Identify the conversation between two users by their ordered ids."""
+    low, high = sorted((user_a, user_b))
+    return (low << 32) | high
+
+
+def insert_rows(session, model: Any, rows: List[Dict[str, Any]]) -> List[int]:
+    """Insert rows with a single multi-row INSERT and return their ids.
+
+    Where the dialect has INSERT ... RETURNING, the ids come back with the rows.
+    MySQL only reports the first id, and the others are not always consecutive:
+    they step by `auto_increment_increment`, and concurrent inserts can
+    interleave with them. So the rows from that id on are read back within the
+    transaction and matched to the inserted ones by their values.
+    """
+    if not rows:
+        return []
+    table = model.__table__
+    if session.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order:
+        statement = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+        return list(session.execute(statement, rows).scalars())
+
+    first_id = session.execute(insert(table).values(rows)).lastrowid
+    if session.get_bind().dialect.name == "sqlite":
+        # SQLite before 3.35, which reports the last id
+        first_id -= len(rows) - 1
+    # Timestamps are stored with less precision than they are sent with.
+    columns = [
+        name
+        for name, value in rows[0].items()
+        if not isinstance(value, datetime.datetime)
+    ]
+    pending = {}
+    for index, row in enumerate(rows):
+        pending.setdefault(tuple(row[name] for name in columns), []).append(index)
+    ids = [None] * len(rows)
+    stored = session.execute(
+        select(table.c.id, *[table.c[name] for name in columns])
+        .where(table.c.id >= first_id)
+        .order_by(table.c.id.asc())
+        .execution_options(yield_per=len(rows))
+    )
+    remaining = len(rows)
+    for stored_row in stored:
+        indexes = pending.get(tuple(stored_row[1:]))
+        if indexes:
+            ids[indexes.pop(0)] = stored_row.id
+            remaining -= 1
+            if not remaining:
+                break
+    stored.close()
+    if remaining:
+        raise RuntimeError(f"Could not read back the ids of {remaining} inserted rows")
+    return ids
+
+
+def insert_ignore_rows(session, model: Any, rows: List[Dict[str, Any]]) -> None:
+    """Insert rows that carry their own id, skipping ids that already exist."""
+    if rows:
+        statement = (
+            insert(model.__table__)
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite")
+        )
+        session.execute(statement.values(rows))
+
+
+def parse_timestamp(timestamp: str) -> datetime.datetime:
+    return datetime.datetime.strptime(timestamp, TIME_FORMAT)
+
+
+def trigrams(username: str) -> List[str]:
+    """The distinct lowercase 3-character substrings of a username."""
+    lowered = username.lower()
+    return sorted({lowered[i : i + 3] for i in range(len(lowered) - 2)})
+
+
+def trigram_rows(user_id: int, username: str) -> List[Dict[str, Any]]:
+    return [{"trigram": gram, "user_id": user_id} for gram in trigrams(username)]
+
 
 # Define the Users model
 class Users(db.Model):
@@ -38,6 +137,11 @@ class Users(db.Model):
 # Define the PublicRoomMessages model
 class PublicRoomMessages(db.Model):
     __tablename__ = "PublicRoomMessages"
+    __table_args__ = (
+        db.Index("ix_PublicRoomMessages_room_name_id", "room_name", "id"),
+        db.Index("ix_PublicRoomMessages_timestamp", "timestamp"),
+        db.Index("ix_PublicRoomMessages_room_name_timestamp", "room_name", "timestamp"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("Users.id"))
     message = db.Column(db.Text, nullable=False)
@@ -62,9 +166,18 @@ class PublicRoomMessages(db.Model):
 # Define the UserChat model
 class UserChat(db.Model):
     __tablename__ = "UserChats"
+    # One index per direction of a conversation; `chat_list` reads each of them
+    # for its peers and `read_messages` pages both of them by id.
+    __table_args__ = (
+        db.Index("ix_UserChats_sender_receiver_id", "sender_id", "receiver_id", "id"),
+        db.Index("ix_UserChats_receiver_sender_id", "receiver_id", "sender_id", "id"),
+        db.Index("ix_UserChats_conversation_id_id", "conversation_id", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey("Users.id"))
     receiver_id = db.Column(db.Integer, db.ForeignKey("Users.id"))
+    # `conversation_key` of the two users; NULL only on rows not backfilled yet
+    conversation_id = db.Column(db.BigInteger)
     message = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.TIMESTAMP, default=CURRENT_TIMESTAMP)
     sender = db.relationship(
@@ -88,6 +201,15 @@ class UserChat(db.Model):
         return self.timestamp.strftime(TIME_FORMAT)
 
 
+# Define the UsernameTrigram model
+class UsernameTrigram(db.Model):
+    __tablename__ = "UsernameTrigrams"
+    # One row per trigram of each username; the primary key doubles as the
+    # posting list of a trigram for the substring search.
+    trigram = db.Column(db.String(3), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("Users.id"), primary_key=True)
+
+
 # Define the Session model
 class Session(db.Model):
     __tablename__ = "Sessions"
@@ -99,15 +221,22 @@ class Session(db.Model):
 
 # Database connection and session management
 class DatabaseConnection:
+    # Tables and indexes are created by `migrations.upgrade`, which runs once
+    # per deployment instead of at import in every worker.
     def __init__(self, app):
         self.app = app
-        with self.app.app_context():
-            db.create_all()
 
 
 class UserManager:
-    def __init__(self, session) -> None:
+    def __init__(
+        self,
+        session,
+        session_cache: Optional[SessionCache] = None,
+        chat_index: Optional[ChatIndex] = None,
+    ) -> None:
         self.session = session
+        self.session_cache = session_cache
+        self.chat_index = chat_index
 
     def register(self, username: str, name: str, password: str, email: str) -> None:
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
@@ -115,6 +244,10 @@ class UserManager:
             username=username, name=name, password=hashed_password, email=email
         )
         self.session.add(new_user)
+        self.session.flush()
+        insert_ignore_rows(
+            self.session, UsernameTrigram, trigram_rows(new_user.id, username)
+        )
         self.session.commit()
 
     def login(
@@ -136,55 +269,163 @@ class UserManager:
             return None
 
     def is_session_valid(self, user_id: int, session_id: str) -> bool:
+        if self.session_cache is not None and self.session_cache.get(
+            user_id, session_id
+        ):
+            return True
+
         session_info = (
             self.session.query(Session)
             .filter_by(session_id=session_id, user_id=user_id)
             .first()
         )
+        if session_info and self.session_cache is not None:
+            self.session_cache.add(user_id, session_id)
         return bool(session_info)
 
     def logout(self, session_id: str) -> None:
         self.session.query(Session).filter_by(session_id=session_id).delete()
         self.session.commit()
+        if self.session_cache is not None:
+            self.session_cache.invalidate([session_id])
 
     def find_by_username(
-        self, username: str, limit: int = 5, offset: int = 0
+        self,
+        username: str,
+        limit: int = 5,
+        offset: int = 0,
+        mode: str = SEARCH_SUBSTRING,
     ) -> List[Tuple[int, str]]:
-        users = (
-            self.session.query(Users)
-            .filter(Users.username.like(f"%{username}%"))
-            .limit(limit)
-            .offset(offset)
+        """Users whose username starts with (or contains) `username`, best first.
+
+        The exact match comes first, then the other prefix matches, then the
+        remaining substring matches, each group in username order. Prefix
+        matches are a range of the unique username index; substring matches
+        are looked up through the trigrams of `username`. Queries shorter than
+        three characters have no trigram, so their substring matches are read
+        by walking the username index until the page is full.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        is_prefix = Users.username.startswith(username, autoescape=True)
+        prefix = (
+            self.session.query(Users.id, Users.username)
+            .filter(is_prefix)
+            .order_by(Users.username.asc())
+            .limit(offset + limit)
+            .all()
+        )
+        users = prefix[offset:]
+        grams = trigrams(username)
+        if mode == SEARCH_PREFIX or len(users) == limit:
+            return [(user.id, user.username) for user in users]
+
+        # Fewer prefix matches than the page needs: all of them were read, so
+        # the substring matches start at the remainder of the offset.
+        query = self.session.query(Users.id, Users.username)
+        if grams:
+            candidates = (
+                self.session.query(UsernameTrigram.user_id)
+                .filter(UsernameTrigram.trigram.in_(grams))
+                .group_by(UsernameTrigram.user_id)
+                .having(func.count() == len(grams))
+                .subquery()
+            )
+            query = query.join(candidates, candidates.c.user_id == Users.id)
+        users += (
+            query.filter(Users.username.contains(username, autoescape=True))
+            .filter(~is_prefix)
+            .order_by(Users.username.asc())
+            .offset(max(0, offset - len(prefix)))
+            .limit(limit - len(users))
             .all()
         )
         return [(user.id, user.username) for user in users]
 
+    def names(self, user_ids: List[int]) -> Dict[int, str]:
+        """The stored names of the users, by id; unknown ids are left out."""
+        if not user_ids:
+            return {}
+        rows = self.session.query(Users.id, Users.name).filter(Users.id.in_(user_ids))
+        return {row.id: row.name for row in rows}
+
     def find_by_user_id(self, user_id: int) -> Optional[Tuple[int, str, str, str]]:
         user = self.session.query(Users).filter_by(id=user_id).first()
         return (user.id, user.username, user.name, user.email) if user else None
 
     def chat_list(
         self, user_id: int, limit: int = 10, offset: int = 0
-    ) -> List[Tuple[int, str]]:
-        subquery = (
-            self.session.query(UserChat.sender_id.label("intr"))
-            .filter(UserChat.receiver_id == user_id)
-            .union(
-                self.session.query(UserChat.receiver_id.label("intr")).filter(
-                    UserChat.sender_id == user_id
-                )
+    ) -> List[Tuple[int, str, str, str]]:
+        """Peers of the user, most recent conversation first.
+
+        Each entry is `(peer_id, username, preview, timestamp)` of the last
+        message exchanged with the peer.
+        """
+        entries = None
+        if self.chat_index is not None:
+            entries = self.chat_index.page(user_id, limit, offset)
+        if entries is None:
+            chats = self.recent_chats(user_id)
+            if self.chat_index is not None:
+                self.chat_index.rebuild(user_id, chats)
+            entries = [
+                (peer_id, message[:PREVIEW_LENGTH], timestamp)
+                for peer_id, message, timestamp in chats[offset : offset + limit]
+            ]
+
+        usernames = self.usernames([peer_id for peer_id, _, _ in entries])
+        return [
+            (peer_id, usernames[peer_id], preview, timestamp)
+            for peer_id, preview, timestamp in entries
+            if peer_id in usernames
+        ]
+
+    def recent_chats(self, user_id: int) -> List[Tuple[int, str, str]]:
+        """`(peer_id, message, timestamp)` of the last message per peer, from MySQL."""
+        sent = (
+            self.session.query(
+                UserChat.receiver_id.label("peer_id"), func.max(UserChat.id)
+            )
+            .filter(UserChat.sender_id == user_id)
+            .group_by(UserChat.receiver_id)
+        )
+        received = (
+            self.session.query(
+                UserChat.sender_id.label("peer_id"), func.max(UserChat.id)
             )
-            .subquery()
+            .filter(UserChat.receiver_id == user_id)
+            .group_by(UserChat.sender_id)
+        )
+        last_ids = {}
+        for peer_id, last_id in sent.union_all(received):
+            last_ids[peer_id] = max(last_id, last_ids.get(peer_id, 0))
+        if not last_ids:
+            return []
+
+        messages = (
+            self.session.query(UserChat)
+            .filter(UserChat.id.in_(list(last_ids.values())))
+            .order_by(UserChat.id.desc())
+            .all()
         )
+        return [
+            (
+                msg.receiver_id if msg.sender_id == user_id else msg.sender_id,
+                msg.message,
+                msg.formatted_timestamp,
+            )
+            for msg in messages
+        ]
 
-        chat_users = (
+    def usernames(self, user_ids: List[int]) -> Dict[int, str]:
+        if not user_ids:
+            return {}
+        users = (
             self.session.query(Users.id, Users.username)
-            .join(subquery, Users.id == subquery.c.intr)
-            .limit(limit)
-            .offset(offset)
+            .filter(Users.id.in_(user_ids))
             .all()
         )
-        return [(chat.id, chat.username) for chat in chat_users]
+        return {user.id: user.username for user in users}
 
     def update(
         self, user_id: int, username: str, name: str, password: str, email: str
@@ -198,16 +439,35 @@ class UserManager:
                 Users.username: username,
             }
         )
+        self.session.query(UsernameTrigram).filter_by(user_id=user_id).delete()
+        insert_ignore_rows(
+            self.session, UsernameTrigram, trigram_rows(user_id, username)
+        )
         self.session.commit()
 
+    def session_ids(self, user_id: int) -> List[str]:
+        return [
+            session_id
+            for (session_id,) in self.session.query(Session.session_id).filter_by(
+                user_id=user_id
+            )
+        ]
+
     def delete(self, user_id: int) -> None:
+        session_ids = self.session_ids(user_id)
+        self.session.query(UsernameTrigram).filter_by(user_id=user_id).delete()
         self.session.query(Users).filter_by(id=user_id).delete()
         self.session.commit()
+        if self.session_cache is not None:
+            self.session_cache.invalidate(session_ids)
+        if self.chat_index is not None:
+            self.chat_index.forget(user_id)
 
 
 class PublicManager:
-    def __init__(self, session) -> None:
+    def __init__(self, session, room_history: Optional[RoomHistory] = None) -> None:
         self.session = session
+        self.room_history = room_history
 
     def send_message(
         self, user_id: int, message: str, room_name: str
@@ -219,15 +479,62 @@ class PublicManager:
         self.session.commit()
         return new_message.to_tuple()
 
+    def send_messages(
+        self, messages: List[Tuple[int, str, str]]
+    ) -> List[Tuple[int, int, str, str, str]]:
+        """Store `(user_id, message, room_name)` triples in one transaction."""
+        timestamp = CURRENT_TIMESTAMP()
+        rows = [
+            {
+                "user_id": user_id,
+                "message": message,
+                "room_name": room_name,
+                "timestamp": timestamp,
+            }
+            for user_id, message, room_name in messages
+        ]
+        ids = insert_rows(self.session, PublicRoomMessages, rows)
+        self.session.commit()
+        formatted = timestamp.strftime(TIME_FORMAT)
+        return [
+            (message_id, row["user_id"], row["message"], row["room_name"], formatted)
+            for message_id, row in zip(ids, rows)
+        ]
+
+    def store_messages(self, rows: List[Tuple[int, int, str, str, str]]) -> None:
+        """Store rows in the `send_message` format that already have an id.
+
+        An id that is already stored raises `IntegrityError`, like any other
+        constraint; callers that replay rows must check them first.
+        """
+        if not rows:
+            return
+        self.session.execute(
+            insert(PublicRoomMessages.__table__),
+            [
+                {
+                    "id": message_id,
+                    "user_id": user_id,
+                    "message": message,
+                    "room_name": room_name,
+                    "timestamp": parse_timestamp(timestamp),
+                }
+                for message_id, user_id, message, room_name, timestamp in rows
+            ],
+        )
+        self.session.commit()
+
     def read_messages(
         self,
         limit: int = 100,
         offset: int = 0,
         timestamp: datetime.datetime = datetime.datetime.now(),
+        room_name: str = DEFAULT_ROOM,
     ) -> List[Tuple[int, str, str, str]]:
         messages = (
             self.session.query(PublicRoomMessages, Users.name)
             .join(Users, PublicRoomMessages.user_id == Users.id)
+            .filter(PublicRoomMessages.room_name == room_name)
             .filter(PublicRoomMessages.timestamp > timestamp)
             .order_by(PublicRoomMessages.timestamp.asc())
             .limit(limit)
@@ -244,21 +551,247 @@ class PublicManager:
             for msg in messages
         ]
 
+    def read_page(
+        self,
+        limit: int = 100,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+        room_name: str = DEFAULT_ROOM,
+    ) -> Page:
+        """Keyset page of the messages of a room, oldest first.
+
+        With `after_id` the page starts right after that message; otherwise it
+        ends right before `before_id`, or at the newest message if neither is
+        given. Returns the rows with the ids of the first and last one.
+        Windows within the newest messages of the room come from Redis.
+        """
+        if self.room_history is not None:
+            page, seed = self.room_history.page(room_name, limit, after_id, before_id)
+            if seed:
+                # Queued rows are read first: once stored, they leave the stream.
+                queued = self.room_history.queued(room_name)
+                if queued is not None:
+                    self.room_history.seed(
+                        room_name,
+                        self.recent_messages(room_name, self.room_history.size),
+                        self.queued_messages(queued),
+                    )
+            if page is not None:
+                return page
+
+        query = (
+            self.session.query(PublicRoomMessages, Users.name)
+            .join(Users, PublicRoomMessages.user_id == Users.id)
+            .filter(PublicRoomMessages.room_name == room_name)
+        )
+        if after_id is not None:
+            query = query.filter(PublicRoomMessages.id > after_id).order_by(
+                PublicRoomMessages.id.asc()
+            )
+        else:
+            if before_id is not None:
+                query = query.filter(PublicRoomMessages.id < before_id)
+            query = query.order_by(PublicRoomMessages.id.desc())
+
+        messages = query.limit(limit).all()
+        if after_id is None:
+            messages.reverse()
+        if not messages:
+            return [], None, None
+
+        rows = [
+            (
+                msg.PublicRoomMessages.user_id,
+                msg.PublicRoomMessages.message,
+                msg.PublicRoomMessages.formatted_timestamp,
+                msg.name,
+            )
+            for msg in messages
+        ]
+        return (
+            rows,
+            messages[0].PublicRoomMessages.id,
+            messages[-1].PublicRoomMessages.id,
+        )
+
+    def recent_messages(
+        self, room_name: str, limit: int
+    ) -> List[Tuple[int, int, str, str, str]]:
+        """`(id, user_id, message, timestamp, name)` of the newest messages."""
+        # The read must see every message whose append to the room history
+        # was skipped before seeding started, so it needs a fresh snapshot.
+        self.session.commit()
+        messages = (
+            self.session.query(PublicRoomMessages, Users.name)
+            .join(Users, PublicRoomMessages.user_id == Users.id)
+            .filter(PublicRoomMessages.room_name == room_name)
+            .order_by(PublicRoomMessages.id.desc())
+            .limit(limit)
+            .all()
+        )
+        return [
+            (
+                msg.PublicRoomMessages.id,
+                msg.PublicRoomMessages.user_id,
+                msg.PublicRoomMessages.message,
+                msg.PublicRoomMessages.formatted_timestamp,
+                msg.name,
+            )
+            for msg in reversed(messages)
+        ]
+
+    def queued_messages(
+        self, rows: List[Tuple[int, int, str, str, str]]
+    ) -> List[Tuple[int, int, str, str, str]]:
+        """`recent_messages` entries of rows that are not stored yet."""
+        names = UserManager(self.session).names(sorted({row[1] for row in rows}))
+        return [
+            (message_id, user_id, message, timestamp, names.get(user_id))
+            for message_id, user_id, message, _, timestamp in rows
+        ]
+
+
+class ConversationSwitch:
+    """Whether reads may rely on `UserChat.conversation_id` yet.
+
+    Shared by the managers of one process, so the backfill is checked at most
+    once per `CONVERSATION_CHECK_INTERVAL`.
+    """
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.checked_at = 0.0
+
 
 class PrivateManager:
-    def __init__(self, session) -> None:
+    def __init__(
+        self, session, conversations: Optional[ConversationSwitch] = None
+    ) -> None:
         self.session = session
+        self.conversations = conversations or ConversationSwitch()
 
     def send_message(
         self, sender_id: int, receiver_id: int, message: str
     ) -> Tuple[int, int, int, str, str]:
         new_message = UserChat(
-            sender_id=sender_id, receiver_id=receiver_id, message=message
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            message=message,
+            conversation_id=conversation_key(sender_id, receiver_id),
         )
         self.session.add(new_message)
         self.session.commit()
         return new_message.to_tuple()
 
+    def send_messages(
+        self, messages: List[Tuple[int, int, str]]
+    ) -> List[Tuple[int, int, int, str, str]]:
+        """Store `(sender_id, receiver_id, message)` triples in one transaction."""
+        timestamp = CURRENT_TIMESTAMP()
+        rows = [
+            {
+                "sender_id": sender_id,
+                "receiver_id": receiver_id,
+                "message": message,
+                "conversation_id": conversation_key(sender_id, receiver_id),
+                "timestamp": timestamp,
+            }
+            for sender_id, receiver_id, message in messages
+        ]
+        ids = insert_rows(self.session, UserChat, rows)
+        self.session.commit()
+        formatted = timestamp.strftime(TIME_FORMAT)
+        return [
+            (
+                message_id,
+                row["sender_id"],
+                row["receiver_id"],
+                row["message"],
+                formatted,
+            )
+            for message_id, row in zip(ids, rows)
+        ]
+
+    def store_messages(self, rows: List[Tuple[int, int, int, str, str]]) -> None:
+        """Store rows in the `send_message` format that already have an id.
+
+        Ids that are already stored raise `IntegrityError`, as in
+        `PublicManager.store_messages`.
+        """
+        if not rows:
+            return
+        self.session.execute(
+            insert(UserChat.__table__),
+            [
+                {
+                    "id": message_id,
+                    "sender_id": sender_id,
+                    "receiver_id": receiver_id,
+                    "message": message,
+                    "conversation_id": conversation_key(sender_id, receiver_id),
+                    "timestamp": parse_timestamp(timestamp),
+                }
+                for message_id, sender_id, receiver_id, message, timestamp in rows
+            ],
+        )
+        self.session.commit()
+
+    def conversations_ready(self) -> bool:
+        """Whether every row carries a conversation id.
+
+        Until `backfill_conversation_ids` has caught up, reads keep matching
+        both directions of the conversation; the switch happens on its own.
+        """
+        if self.conversations.ready:
+            return True
+        now = time.monotonic()
+        if now - self.conversations.checked_at < CONVERSATION_CHECK_INTERVAL:
+            return False
+        self.conversations.checked_at = now
+        pending = (
+            self.session.query(UserChat.id)
+            .filter(UserChat.conversation_id.is_(None))
+            .first()
+        )
+        self.conversations.ready = pending is None
+        return self.conversations.ready
+
+    def _conversation_filter(self, sender_id: int, receiver_id: int) -> Any:
+        if self.conversations_ready():
+            return UserChat.conversation_id == conversation_key(sender_id, receiver_id)
+        return (
+            (UserChat.sender_id == sender_id) & (UserChat.receiver_id == receiver_id)
+        ) | ((UserChat.sender_id == receiver_id) & (UserChat.receiver_id == sender_id))
+
+    def backfill_conversation_ids(self, batch_size: int = 1000) -> int:
+        """Fill in missing conversation ids in batches; returns the row count."""
+        key = case(
+            (
+                UserChat.sender_id < UserChat.receiver_id,
+                UserChat.sender_id * 4294967296 + UserChat.receiver_id,
+            ),
+            else_=UserChat.receiver_id * 4294967296 + UserChat.sender_id,
+        )
+        total = 0
+        while True:
+            ids = [
+                row.id
+                for row in self.session.query(UserChat.id)
+                .filter(UserChat.conversation_id.is_(None))
+                .order_by(UserChat.id.asc())
+                .limit(batch_size)
+            ]
+            if not ids:
+                break
+            total += (
+                self.session.query(UserChat)
+                .filter(UserChat.id.between(ids[0], ids[-1]))
+                .filter(UserChat.conversation_id.is_(None))
+                .update({UserChat.conversation_id: key}, synchronize_session=False)
+            )
+            self.session.commit()
+        return total
+
     def read_messages(
         self,
         sender_id: int,
@@ -279,16 +812,7 @@ class PrivateManager:
             )
             .join(sender_alias, UserChat.sender_id == sender_alias.id)
             .join(receiver_alias, UserChat.receiver_id == receiver_alias.id)
-            .filter(
-                (
-                    (UserChat.sender_id == sender_id)
-                    & (UserChat.receiver_id == receiver_id)
-                )
-                | (
-                    (UserChat.sender_id == receiver_id)
-                    & (UserChat.receiver_id == sender_id)
-                )
-            )
+            .filter(self._conversation_filter(sender_id, receiver_id))
             .filter(UserChat.timestamp > timestamp)
             .order_by(UserChat.timestamp.asc())
             .limit(limit)
@@ -307,11 +831,90 @@ class PrivateManager:
             for msg in messages
         ]
 
+    def read_page(
+        self,
+        sender_id: int,
+        receiver_id: int,
+        limit: int = 100,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+    ) -> Tuple[List[Tuple[int, str, int, str, str, str]], Optional[int], Optional[int]]:
+        """Keyset page of a conversation, oldest first.
+
+        Paging works as in `PublicManager.read_page`.
+        """
+        sender_alias = aliased(Users, name="sender")
+        receiver_alias = aliased(Users, name="receiver")
+
+        query = (
+            self.session.query(
+                UserChat,
+                sender_alias.name.label("sender_name"),
+                receiver_alias.name.label("receiver_name"),
+            )
+            .join(sender_alias, UserChat.sender_id == sender_alias.id)
+            .join(receiver_alias, UserChat.receiver_id == receiver_alias.id)
+            .filter(self._conversation_filter(sender_id, receiver_id))
+        )
+        if after_id is not None:
+            query = query.filter(UserChat.id > after_id).order_by(UserChat.id.asc())
+        else:
+            if before_id is not None:
+                query = query.filter(UserChat.id < before_id)
+            query = query.order_by(UserChat.id.desc())
+
+        messages = query.limit(limit).all()
+        if after_id is None:
+            messages.reverse()
+        if not messages:
+            return [], None, None
+
+        rows = [
+            (
+                msg.UserChat.sender_id,
+                msg.sender_name,
+                msg.UserChat.receiver_id,
+                msg.receiver_name,
+                msg.UserChat.message,
+                msg.UserChat.formatted_timestamp,
+            )
+            for msg in messages
+        ]
+        return rows, messages[0].UserChat.id, messages[-1].UserChat.id
+
 
 # Messenger class
 class Messenger:
-    def __init__(self, app):
+    def __init__(self, app, redis_client: Optional[Any] = None):
         self.db_connection = DatabaseConnection(app)
-        self.user = UserManager(db.session)
-        self.public = PublicManager(db.session)
+        self.session_cache = SessionCache(
+            redis_client,
+            ttl=app.config.get("SESSION_CACHE_TTL", 300),
+            local_ttl=app.config.get("SESSION_CACHE_LOCAL_TTL", 5.0),
+            maxsize=app.config.get("SESSION_CACHE_SIZE", 10000),
+        )
+        self.chat_index = ChatIndex(redis_client) if redis_client is not None else None
+        self.events = (
+            EventLog(
+                redis_client,
+                maxlen=app.config.get("EVENT_LOG_LENGTH", 1000),
+                ttl=app.config.get("EVENT_LOG_TTL", 86400),
+            )
+            if redis_client is not None
+            else None
+        )
+        self.room_history = (
+            RoomHistory(
+                redis_client,
+                size=app.config.get("ROOM_HISTORY_SIZE", 200),
+                ttl=app.config.get("ROOM_HISTORY_TTL", 3600),
+                ingest_stream=(
+                    INGEST_STREAM if app.config.get("INGEST_MODE") == "stream" else None
+                ),
+            )
+            if redis_client is not None
+            else None
+        )
+        self.user = UserManager(db.session, self.session_cache, self.chat_index)
+        self.public = PublicManager(db.session, self.room_history)
         self.private = PrivateManager(db.session)
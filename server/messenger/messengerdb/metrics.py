@@ -0,0 +1,111 @@
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from beartype.typing import Any, Tuple
+
+SESSION_CACHE_LOOKUPS = Counter(
+    "messenger_session_cache_lookups_total",
+    "Session validations by the tier that answered them",
+    ["result"],
+)
+SESSION_CACHE_INVALIDATIONS = Counter(
+    "messenger_session_cache_invalidations_total",
+    "Sessions evicted from the session cache by logout or user deletion",
+)
+ROOM_HISTORY_READS = Counter(
+    "messenger_room_history_reads_total",
+    "Paged public room reads by whether the Redis window served them",
+    ["result"],
+)
+
+REQUESTS = Counter(
+    "messenger_requests_total",
+    "Requests by route, method and status code",
+    ["route", "method", "status"],
+)
+REQUEST_SECONDS = Histogram(
+    "messenger_request_duration_seconds",
+    "Time taken to serve a request, by route",
+    ["route"],
+)
+REQUEST_STATEMENTS = Histogram(
+    "messenger_request_db_statements",
+    "SQL statements executed while serving a request, by route",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+REQUEST_DB_SECONDS = Histogram(
+    "messenger_request_db_seconds",
+    "Time spent in SQL statements while serving a request, by route",
+    ["route"],
+)
+DB_STATEMENTS = Counter(
+    "messenger_db_statements_total",
+    "SQL statements executed, by kind",
+    ["kind"],
+)
+DB_STATEMENT_SECONDS = Histogram(
+    "messenger_db_statement_seconds",
+    "Time taken by a SQL statement, by kind",
+    ["kind"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+SLOW_DB_STATEMENTS = Counter(
+    "messenger_slow_db_statements_total",
+    "SQL statements over SLOW_QUERY_SECONDS, by kind, when profiling",
+    ["kind"],
+)
+STATEMENT_HEAVY_REQUESTS = Counter(
+    "messenger_statement_heavy_requests_total",
+    "Requests over MAX_REQUEST_STATEMENTS statements, by route, when profiling",
+    ["route"],
+)
+REDIS_PUBLISH_SECONDS = Histogram(
+    "messenger_redis_publish_seconds",
+    "Time taken by the Redis pipelines that publish new messages",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+def observe_request(
+    route: str,
+    method: str,
+    status: int,
+    seconds: float,
+    statements: int,
+    db_seconds: float,
+) -> None:
+    REQUESTS.labels(route, method, str(status)).inc()
+    REQUEST_SECONDS.labels(route).observe(seconds)
+    REQUEST_STATEMENTS.labels(route).observe(statements)
+    REQUEST_DB_SECONDS.labels(route).observe(db_seconds)
+
+
+# Collectors that compute their values when scraped, e.g. from Redis
+COLLECTORS = []
+
+
+def register_collector(collector: Any) -> None:
+    COLLECTORS.append(collector)
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        REGISTRY.register(collector)
+
+
+def render() -> Tuple[bytes, str]:
+    # gunicorn runs several workers, each with its own counters; in that case
+    # the values are shared through files in PROMETHEUS_MULTIPROC_DIR.
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in COLLECTORS:
+            registry.register(collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
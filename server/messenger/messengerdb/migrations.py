@@ -0,0 +1,153 @@
+import logging
+from sqlalchemy import inspect, insert, select, text
+from beartype.typing import Any, Callable, List, Tuple
+
+from .messenger import (
+    CURRENT_TIMESTAMP,
+    PublicRoomMessages,
+    UserChat,
+    UsernameTrigram,
+    Users,
+    db,
+    insert_ignore_rows,
+    trigram_rows,
+)
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = "messengerdb-migrations"
+LOCK_TIMEOUT = 300
+
+# (version, name, apply); `apply` receives a connection and must be idempotent,
+# since MySQL commits every DDL statement on its own.
+MIGRATIONS: List[Tuple[int, str, Callable]] = []
+
+
+class SchemaVersion(db.Model):
+    __tablename__ = "SchemaVersions"
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.TIMESTAMP, default=CURRENT_TIMESTAMP)
+
+
+def migration(version: int, name: str) -> Callable:
+    def register(apply: Callable) -> Callable:
+        MIGRATIONS.append((version, name, apply))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return apply
+
+    return register
+
+
+def index_named(model: Any, name: str) -> Any:
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+def create_index_if_missing(connection, index: Any) -> None:
+    existing = inspect(connection).get_indexes(index.table.name)
+    if index.name not in {item["name"] for item in existing}:
+        index.create(connection)
+
+
+def add_column_if_missing(connection, column: Any) -> None:
+    existing = inspect(connection).get_columns(column.table.name)
+    if column.name not in {item["name"] for item in existing}:
+        preparer = connection.dialect.identifier_preparer
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute(
+            text(
+                f"ALTER TABLE {preparer.format_table(column.table)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+            )
+        )
+
+
+@migration(1, "baseline tables")
+def create_tables(connection) -> None:
+    db.metadata.create_all(connection)
+
+
+@migration(2, "message history indexes")
+def create_message_indexes(connection) -> None:
+    for model, name in (
+        (UserChat, "ix_UserChats_sender_receiver_id"),
+        (UserChat, "ix_UserChats_receiver_sender_id"),
+        (PublicRoomMessages, "ix_PublicRoomMessages_room_name_id"),
+        (PublicRoomMessages, "ix_PublicRoomMessages_timestamp"),
+    ):
+        create_index_if_missing(connection, index_named(model, name))
+
+
+@migration(3, "conversation id on private messages")
+def add_conversation_id(connection) -> None:
+    add_column_if_missing(connection, UserChat.__table__.c.conversation_id)
+    create_index_if_missing(
+        connection, index_named(UserChat, "ix_UserChats_conversation_id_id")
+    )
+
+
+@migration(4, "username trigram index")
+def index_usernames(connection, batch_size: int = 1000) -> None:
+    UsernameTrigram.__table__.create(connection, checkfirst=True)
+    last_id = 0
+    while True:
+        users = connection.execute(
+            select(Users.id, Users.username)
+            .where(Users.id > last_id)
+            .order_by(Users.id.asc())
+            .limit(batch_size)
+        ).all()
+        if not users:
+            break
+        rows = [row for user in users for row in trigram_rows(user.id, user.username)]
+        insert_ignore_rows(connection, UsernameTrigram, rows)
+        connection.commit()
+        last_id = users[-1].id
+
+
+@migration(5, "public room timestamp index")
+def index_room_timestamps(connection) -> None:
+    create_index_if_missing(
+        connection,
+        index_named(PublicRoomMessages, "ix_PublicRoomMessages_room_name_timestamp"),
+    )
+
+
+def applied_versions(engine) -> List[int]:
+    with engine.begin() as connection:
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        return list(connection.execute(select(SchemaVersion.version)).scalars())
+
+
+def upgrade(engine) -> List[int]:
+    """Apply pending migrations in order and return their versions."""
+    applied = []
+    with engine.connect() as connection:
+        if connection.dialect.name == "mysql":
+            # Several containers may start at once; only one migrates.
+            locked = connection.execute(
+                text("SELECT GET_LOCK(:name, :timeout)"),
+                {"name": LOCK_NAME, "timeout": LOCK_TIMEOUT},
+            ).scalar()
+            if locked != 1:
+                raise RuntimeError("Timed out waiting for the migration lock")
+        try:
+            SchemaVersion.__table__.create(connection, checkfirst=True)
+            done = set(connection.execute(select(SchemaVersion.version)).scalars())
+            connection.commit()
+            for version, name, apply in MIGRATIONS:
+                if version in done:
+                    continue
+                logger.info(f"Applying migration {version}: {name}")
+                apply(connection)
+                connection.execute(
+                    insert(SchemaVersion).values(version=version, name=name)
+                )
+                connection.commit()
+                applied.append(version)
+        finally:
+            if connection.dialect.name == "mysql":
+                connection.execute(
+                    text("SELECT RELEASE_LOCK(:name)"), {"name": LOCK_NAME}
+                )
+    return applied
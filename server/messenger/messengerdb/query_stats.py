@@ -0,0 +1,172 @@
+import logging
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from beartype.typing import Any, Dict, Optional
+
+from .explain import EXPLAINABLE, explain_statement
+from .metrics import (
+    DB_STATEMENTS,
+    DB_STATEMENT_SECONDS,
+    SLOW_DB_STATEMENTS,
+    STATEMENT_HEAVY_REQUESTS,
+)
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("select", "insert", "update", "delete")
+
+# Statements of a flagged request that are listed in its log entry
+REPEATED_STATEMENTS_LOGGED = 5
+
+# Profiling is off until `configure` turns it on.
+_slow_seconds = 0.0
+_max_statements = 0
+
+
+class QueryStats:
+    """SQL statements executed while serving one request."""
+
+    def __init__(self) -> None:
+        self.statements = 0
+        self.seconds = 0.0
+        # Time from the start of each commit to its end, flushes included
+        self.commit_seconds = 0.0
+        # Executions of each statement, kept while requests are checked
+        self.repeats: Dict[str, int] = {}
+
+
+# Set per request; async sessions run their statements in greenlets that
+# SQLAlchemy starts with the context of the calling task, so it is seen there.
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+def configure(slow_seconds: float = 0.0, max_statements: int = 0) -> None:
+    """Turn on the profiling of statements and requests; 0 turns either off.
+
+    Statements that take at least `slow_seconds` are logged with their
+    parameters and, on MySQL, their query plan. Requests that execute more
+    than `max_statements` statements are logged with their most repeated ones.
+    """
+    global _slow_seconds, _max_statements
+    _slow_seconds = slow_seconds
+    _max_statements = max_statements
+
+
+def start() -> QueryStats:
+    """Count the statements of the current request from now on."""
+    stats = QueryStats()
+    _current.set(stats)
+    return stats
+
+
+def stop(route: str) -> QueryStats:
+    """Stop counting, and return the statements of the current request."""
+    stats = _current.get() or QueryStats()
+    _current.set(None)
+    if _max_statements and stats.statements > _max_statements:
+        STATEMENT_HEAVY_REQUESTS.labels(route).inc()
+        repeated = sorted(stats.repeats.items(), key=lambda item: -item[1])
+        logger.warning(
+            "%s executed %d SQL statements (limit %d), most repeated:\n%s",
+            route,
+            stats.statements,
+            _max_statements,
+            "\n".join(
+                f"  {count} x {statement}"
+                for statement, count in repeated[:REPEATED_STATEMENTS_LOGGED]
+            ),
+        )
+    return stats
+
+
+def statement_kind(statement: str) -> str:
+    words = statement.split(None, 1)
+    kind = words[0].lower() if words else ""
+    return kind if kind in KINDS else "other"
+
+
+def log_slow_statement(
+    conn: Any, statement: str, parameters: Any, seconds: float, executemany: bool
+) -> None:
+    plan = "not available"
+    explainable = statement.lstrip().upper().startswith(EXPLAINABLE)
+    if conn.dialect.name == "mysql" and explainable and not executemany:
+        try:
+            plan = "\n".join(
+                f"  {row}" for row in explain_statement(conn, statement, parameters)
+            )
+        except Exception as e:
+            plan = f"failed: {e}"
+    logger.warning(
+        "Slow SQL statement (%.3f s): %s\n  parameters: %r\n  plan:\n%s",
+        seconds,
+        statement,
+        parameters,
+        plan,
+    )
+
+
+# Listening on the Engine class covers the Flask-SQLAlchemy engine and the
+# sync engine under each async one.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(
+    conn: Any,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    # Statements of one connection run one at a time.
+    conn.info["query_started"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(
+    conn: Any,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    seconds = time.perf_counter() - conn.info.pop("query_started")
+    if conn.info.get("explaining"):
+        # The EXPLAIN of a slow statement, which the request did not ask for
+        return
+
+    kind = statement_kind(statement)
+    DB_STATEMENTS.labels(kind).inc()
+    DB_STATEMENT_SECONDS.labels(kind).observe(seconds)
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.seconds += seconds
+        if _max_statements:
+            stats.repeats[statement] = stats.repeats.get(statement, 0) + 1
+
+    if _slow_seconds and seconds >= _slow_seconds:
+        SLOW_DB_STATEMENTS.labels(kind).inc()
+        conn.info["explaining"] = True
+        try:
+            log_slow_statement(conn, statement, parameters, seconds, executemany)
+        finally:
+            del conn.info["explaining"]
+
+
+# The ORM listeners cover the Flask-SQLAlchemy session and the sync session
+# under each async one.
+@event.listens_for(Session, "before_commit")
+def _before_commit(session: Any) -> None:
+    session.info["commit_started"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Any) -> None:
+    started = session.info.pop("commit_started", None)
+    stats = _current.get()
+    if started is not None and stats is not None:
+        stats.commit_seconds += time.perf_counter() - started
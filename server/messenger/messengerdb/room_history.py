@@ -0,0 +1,285 @@
+import json
+import logging
+from redis.exceptions import RedisError
+from beartype.typing import Any, List, Optional, Tuple
+
+from .metrics import ROOM_HISTORY_READS
+
+logger = logging.getLogger(__name__)
+
+# `(rows, first_id, last_id)` as returned by `PublicManager.read_page`
+Page = Tuple[List[Tuple], Optional[int], Optional[int]]
+
+# The state key of a room holds "seeding" while the list is being loaded from
+# MySQL, and afterwards the floor: the list holds every message of the room
+# with a larger id. Entries are JSON arrays that start with the message id.
+
+# Append entries to a seeded list, then trim it to ARGV[1] entries and raise
+# the floor past the entries that were dropped.
+APPEND_SCRIPT = """
+local state = redis.call('GET', KEYS[2])
+if not state then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+if state == 'seeding' then
+    return 1
+end
+local floor = tonumber(state)
+local extra = redis.call('LLEN', KEYS[1]) - tonumber(ARGV[1])
+for i = 1, extra do
+    local id = tonumber(string.match(redis.call('LPOP', KEYS[1]), '^%[(%d+),'))
+    if id > floor then
+        floor = id
+    end
+end
+if extra > 0 then
+    redis.call('SET', KEYS[2], floor, 'KEEPTTL')
+end
+return 1
+"""
+
+# Rows queued for MySQL by `MessageIngestor` in write-behind mode
+INGEST_STREAM = "ingest:messages"
+
+# Returns the entries of the page of ARGV[2] messages after the id ARGV[3],
+# or else before the id ARGV[4] (both optional), oldest first. Returns 1 when
+# the caller must seed the list (it has claimed the seeding for ARGV[1]
+# seconds), 0 while another caller seeds it, and 2 when older messages of the
+# page were trimmed from the list.
+PAGE_SCRIPT = """
+local state = redis.call('GET', KEYS[2])
+if not state then
+    redis.call('DEL', KEYS[1])
+    redis.call('SET', KEYS[2], 'seeding', 'EX', ARGV[1])
+    return 1
+end
+if state == 'seeding' then
+    return 0
+end
+local floor = tonumber(state)
+local limit = tonumber(ARGV[2])
+local after_id = tonumber(ARGV[3])
+local before_id = tonumber(ARGV[4])
+if after_id and after_id < floor then
+    return 2
+end
+local entries = {}
+for _, entry in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    local id = tonumber(string.match(entry, '^%[(%d+),'))
+    if id > floor and (not after_id or id > after_id)
+            and (not before_id or id < before_id) then
+        table.insert(entries, {id, entry})
+    end
+end
+table.sort(entries, function(a, b) return a[1] < b[1] end)
+local first, last = 1, math.min(#entries, limit)
+if not after_id then
+    if #entries < limit and floor > 0 then
+        return 2
+    end
+    first, last = math.max(1, #entries - limit + 1), #entries
+end
+local page = {}
+if limit > 0 then
+    for i = first, last do
+        table.insert(page, entries[i][2])
+    end
+end
+return page
+"""
+
+# Merge the newest messages read from MySQL (ARGV[4:]) with the ones appended
+# while they were read, keep the newest ARGV[1] of them and publish the floor.
+SEED_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= 'seeding' then
+    return 0
+end
+local entries = {}
+local seen = {}
+local function add(entry)
+    local id = tonumber(string.match(entry, '^%[(%d+),'))
+    if not seen[id] then
+        seen[id] = true
+        table.insert(entries, {id, entry})
+    end
+end
+for i = 4, #ARGV do
+    add(ARGV[i])
+end
+for _, entry in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    add(entry)
+end
+table.sort(entries, function(a, b) return a[1] < b[1] end)
+local floor = tonumber(ARGV[2])
+local first = math.max(1, #entries - tonumber(ARGV[1]) + 1)
+if first > 1 and entries[first - 1][1] > floor then
+    floor = entries[first - 1][1]
+end
+redis.call('DEL', KEYS[1])
+for i = first, #entries do
+    redis.call('RPUSH', KEYS[1], entries[i][2])
+end
+redis.call('SET', KEYS[2], floor, 'EX', ARGV[3])
+return 1
+"""
+
+
+class RoomHistory:
+    """Capped Redis list of the newest messages of each public room.
+
+    Paged reads that fall inside the list are served without MySQL. A room is
+    loaded from MySQL the first time it is read, and again once its state key
+    expires, so a list that drifted (for example after a Redis failover) is
+    replaced every `ttl` seconds. With `ingest_stream`, the public rows still
+    queued there are loaded too, since MySQL does not have them yet.
+    """
+
+    HISTORY_KEY = "room-history:{}"
+    STATE_KEY = "room-history-state:{}"
+    SEED_TIMEOUT = 30
+    # Queued entries read to seed a room; a longer backlog postpones seeding.
+    MAX_QUEUED = 10000
+
+    def __init__(
+        self,
+        redis_client: Any,
+        size: int = 200,
+        ttl: int = 3600,
+        ingest_stream: Optional[str] = None,
+    ) -> None:
+        self.redis = redis_client
+        self.size = size
+        self.ttl = ttl
+        self.ingest_stream = ingest_stream
+        self._append = redis_client.register_script(APPEND_SCRIPT)
+        self._page = redis_client.register_script(PAGE_SCRIPT)
+        self._seed = redis_client.register_script(SEED_SCRIPT)
+
+    def record(
+        self, row: Tuple[int, int, str, str, str], name: Optional[str], pipe: Any
+    ) -> None:
+        """Queue a public message row, sent by `name`, on `pipe`.
+
+        `name` must be the stored name of the sender, not one sent by a client.
+        """
+        keys, args = self._append_args(row, name)
+        self._append(keys=keys, args=args, client=pipe)
+
+    def page(
+        self,
+        room_name: str,
+        limit: int,
+        after_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+    ) -> Tuple[Optional[Page], bool]:
+        """Serve a `PublicManager.read_page` window from the list.
+
+        Returns the page, or None if the list cannot serve it, and whether
+        the caller should `seed` the room.
+        """
+        try:
+            result = self._page(
+                keys=self._keys(room_name),
+                args=self._page_args(limit, after_id, before_id),
+            )
+        except RedisError as e:
+            logger.debug(f"Room history read failed: {e}")
+            result = 0
+        return self._window(result)
+
+    def queued(self, room_name: str) -> Optional[List[Tuple[int, int, str, str, str]]]:
+        """Public rows of the room in the ingest stream, to be read before MySQL.
+
+        Returns None if the stream could not be read in full, in which case
+        the room must not be seeded.
+        """
+        if self.ingest_stream is None:
+            return []
+        try:
+            entries = self.redis.xrange(self.ingest_stream, count=self.MAX_QUEUED + 1)
+        except RedisError as e:
+            logger.debug(f"Room history queue read failed: {e}")
+            return None
+        return self._queued_rows(entries, room_name)
+
+    def seed(
+        self,
+        room_name: str,
+        entries: List[Tuple[int, int, str, str, str]],
+        queued: List[Tuple[int, int, str, str, str]],
+    ) -> None:
+        """Load a room from the rows of `PublicManager.recent_messages`.
+
+        `queued` are the entries of the rows that were still in the ingest
+        stream before `entries` were read.
+        """
+        try:
+            self._seed(
+                keys=self._keys(room_name), args=self._seed_args(entries, queued)
+            )
+        except RedisError as e:
+            logger.debug(f"Room history seed failed: {e}")
+
+    def _keys(self, room_name: str) -> List[str]:
+        return [self.HISTORY_KEY.format(room_name), self.STATE_KEY.format(room_name)]
+
+    def _append_args(
+        self, row: Tuple[int, int, str, str, str], name: Optional[str]
+    ) -> Tuple[List[str], List[Any]]:
+        message_id, user_id, message, room_name, timestamp = row
+        entry = json.dumps([message_id, user_id, message, timestamp, name])
+        return self._keys(room_name), [self.size, entry]
+
+    def _page_args(
+        self, limit: int, after_id: Optional[int], before_id: Optional[int]
+    ) -> List[Any]:
+        return [
+            self.SEED_TIMEOUT,
+            limit,
+            "" if after_id is None else after_id,
+            "" if before_id is None else before_id,
+        ]
+
+    def _seed_args(
+        self,
+        entries: List[Tuple[int, int, str, str, str]],
+        queued: List[Tuple[int, int, str, str, str]],
+    ) -> List[Any]:
+        # A room with fewer stored messages than the list holds is complete;
+        # the queued rows are all the ones MySQL is missing.
+        floor = entries[0][0] - 1 if len(entries) >= self.size else 0
+        return [
+            self.size,
+            floor,
+            self.ttl,
+            *(json.dumps(e) for e in [*entries, *queued]),
+        ]
+
+    def _queued_rows(
+        self, entries: List[Tuple[Any, Any]], room_name: str
+    ) -> Optional[List[Tuple[int, int, str, str, str]]]:
+        if len(entries) > self.MAX_QUEUED:
+            logger.debug(f"Room history seed of {room_name} waits for the backlog")
+            return None
+        rows = []
+        for _, fields in entries:
+            if fields[b"kind"] == b"public":
+                rows += [
+                    tuple(row)
+                    for row in json.loads(fields[b"rows"])
+                    if row[3] == room_name
+                ]
+        return rows
+
+    def _window(self, result: Any) -> Tuple[Optional[Page], bool]:
+        if not isinstance(result, list):
+            ROOM_HISTORY_READS.labels("fallback").inc()
+            return None, result == 1
+
+        ROOM_HISTORY_READS.labels("hit").inc()
+        if not result:
+            return ([], None, None), False
+        entries = [json.loads(entry) for entry in result]
+        rows = [tuple(entry[1:]) for entry in entries]
+        return (rows, entries[0][0], entries[-1][0]), False
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from redis.exceptions import RedisError
+from beartype.typing import Any, Iterable, List, Optional
+
+from .metrics import SESSION_CACHE_INVALIDATIONS, SESSION_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """Two-tier cache of valid sessions in front of the `Sessions` table.
+
+    The local tier is a small TTL/LRU map private to each worker process. The
+    Redis tier is shared by all workers and lives longer. Only valid sessions
+    are cached, so an unknown session id always falls through to MySQL.
+    Invalidations replace the Redis key with a tombstone and are broadcast to
+    the local tier of every worker over a Redis channel; the short local TTL
+    bounds staleness if a broadcast is missed. `add` never overwrites a key,
+    so a worker that read the session just before it was deleted cannot cache
+    it again after the invalidation.
+    """
+
+    KEY_PREFIX = "session:"
+    INVALIDATION_CHANNEL = "session-invalidations"
+    # Value of an invalidated session's key; no user has the id 0.
+    TOMBSTONE = 0
+    # Longer than a request takes between reading a session and caching it
+    TOMBSTONE_TTL = 60
+
+    def __init__(
+        self,
+        redis_client: Optional[Any] = None,
+        ttl: int = 300,
+        local_ttl: float = 5.0,
+        maxsize: int = 10000,
+    ) -> None:
+        self.redis = redis_client
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.maxsize = maxsize
+        self._local = OrderedDict()  # session_id -> (user_id, expires_at)
+        self._lock = threading.Lock()
+        self._listener = None
+        if self.redis is not None:
+            self._listen_for_invalidations()
+
+    def get(self, user_id: int, session_id: str) -> bool:
+        if self._recall(user_id, session_id):
+            return True
+
+        if self.redis is not None:
+            try:
+                cached = self.redis.get(self.KEY_PREFIX + session_id)
+            except RedisError as e:
+                logger.debug(f"Session cache read failed: {e}")
+                cached = None
+            if cached is not None and int(cached) == user_id:
+                self._remember(user_id, session_id)
+                SESSION_CACHE_LOOKUPS.labels("redis_hit").inc()
+                return True
+
+        SESSION_CACHE_LOOKUPS.labels("miss").inc()
+        return False
+
+    def add(self, user_id: int, session_id: str) -> None:
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                self._queue_add(pipe, user_id, session_id)
+                _, cached = pipe.execute()
+            except RedisError as e:
+                logger.debug(f"Session cache write failed: {e}")
+                cached = None
+            if cached is not None and int(cached) != user_id:
+                # Invalidated while it was being checked
+                return
+        self._remember(user_id, session_id)
+
+    def invalidate(self, session_ids: Iterable[str]) -> None:
+        session_ids = list(session_ids)
+        if not session_ids:
+            return
+        self._forget(session_ids)
+        SESSION_CACHE_INVALIDATIONS.inc(len(session_ids))
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                self._queue_invalidate(pipe, session_ids)
+                pipe.execute()
+            except RedisError as e:
+                logger.debug(f"Session cache invalidation failed: {e}")
+
+    def _queue_add(self, pipe: Any, user_id: int, session_id: str) -> None:
+        key = self.KEY_PREFIX + session_id
+        pipe.set(key, user_id, ex=self.ttl, nx=True)
+        pipe.get(key)
+
+    def _queue_invalidate(self, pipe: Any, session_ids: List[str]) -> None:
+        for session_id in session_ids:
+            pipe.set(
+                self.KEY_PREFIX + session_id, self.TOMBSTONE, ex=self.TOMBSTONE_TTL
+            )
+        pipe.publish(self.INVALIDATION_CHANNEL, " ".join(session_ids))
+
+    def _recall(self, user_id: int, session_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(session_id)
+            if entry is not None:
+                if entry[1] > now:
+                    self._local.move_to_end(session_id)
+                    if entry[0] == user_id:
+                        SESSION_CACHE_LOOKUPS.labels("local_hit").inc()
+                        return True
+                else:
+                    del self._local[session_id]
+        return False
+
+    def _remember(self, user_id: int, session_id: str) -> None:
+        with self._lock:
+            self._local[session_id] = (user_id, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(session_id)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+    def _forget(self, session_ids: Iterable[str]) -> None:
+        with self._lock:
+            for session_id in session_ids:
+                self._local.pop(session_id, None)
+
+    def _listen_for_invalidations(self) -> None:
+        def on_invalidation(message):
+            self._forget(message["data"].decode("utf-8").split())
+
+        def on_error(e, pubsub, thread):
+            # Invalidations may have been missed while disconnected.
+            logger.debug(f"Session invalidation listener failed: {e}")
+            with self._lock:
+                self._local.clear()
+            time.sleep(1)
+
+        try:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.INVALIDATION_CHANNEL: on_invalidation})
+            self._listener = pubsub.run_in_thread(
+                sleep_time=1.0, daemon=True, exception_handler=on_error
+            )
+        except RedisError as e:
+            # Without the broadcast the local tier is only bounded by its TTL.
+            logger.warning(f"Session invalidation listener unavailable: {e}")
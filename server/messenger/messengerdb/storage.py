@@ -0,0 +1,75 @@
+import redis
+import redis.asyncio as aioredis
+from sqlalchemy import create_engine
+from beartype.typing import Any, Dict, Mapping
+
+from .migrations import upgrade
+
+
+class ServiceStorage:
+    """MySQL and the Redis service, as deployed by `docker-compose.yaml`.
+
+    The database is reached through the URIs of the config, and its schema is
+    migrated by `migrate.py` before the workers start.
+    """
+
+    def __init__(self, config: Mapping[str, Any]) -> None:
+        self.config = config
+
+    def prepare_schema(self) -> None:
+        pass
+
+    def redis(self) -> Any:
+        return redis.StrictRedis(
+            host=self.config["REDIS_HOST"], port=self.config["REDIS_PORT"]
+        )
+
+    def async_redis(self) -> Any:
+        return aioredis.StrictRedis(
+            host=self.config["REDIS_HOST"], port=self.config["REDIS_PORT"]
+        )
+
+
+class LocalStorage(ServiceStorage):
+    """A SQLite file and an in-memory Redis, for running without services.
+
+    All the Redis clients of the storage share one fakeredis server, so the
+    notifications, caches and pub/sub of the app work within its process. The
+    state is therefore private to one worker process, and write-behind
+    ingestion, whose worker runs in another process, is not available.
+    """
+
+    def __init__(self, config: Mapping[str, Any]) -> None:
+        if config["INGEST_MODE"] == "stream":
+            raise ValueError("Local storage only supports INGEST_MODE=sync")
+        # Only needed for local storage, from requirements-local.txt
+        import fakeredis
+        import fakeredis.aioredis
+
+        super().__init__(config)
+        self.fakeredis = fakeredis
+        self.server = fakeredis.FakeServer()
+
+    def prepare_schema(self) -> None:
+        engine = create_engine(self.config["SQLALCHEMY_DATABASE_URI"])
+        try:
+            upgrade(engine)
+        finally:
+            engine.dispose()
+
+    def redis(self) -> Any:
+        return self.fakeredis.FakeStrictRedis(server=self.server)
+
+    def async_redis(self) -> Any:
+        return self.fakeredis.aioredis.FakeRedis(server=self.server)
+
+
+STORAGES: Dict[str, type] = {"mysql": ServiceStorage, "local": LocalStorage}
+
+
+def storage_for(config: Mapping[str, Any]) -> ServiceStorage:
+    """The storage named by the `STORAGE` setting of `config`."""
+    name = config["STORAGE"]
+    if name not in STORAGES:
+        raise ValueError(f"Unknown STORAGE {name!r}, expected one of {list(STORAGES)}")
+    return STORAGES[name](config)
@@ -0,0 +1,73 @@
+import json
+import logging
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from beartype.typing import Any, Optional
+
+# Request header carrying the trace id, minted by Nginx or by the client
+HEADER = "X-Trace-Id"
+
+# Trace ids travel inside space-separated pub/sub messages and log lines.
+VALID_TRACE_ID = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+SERVICE = "messenger"
+
+logger = logging.getLogger("tchat.trace")
+logger.propagate = False
+
+# Tracing is off until `configure` gives it a file.
+_enabled = False
+
+_current: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+
+def configure(path: Optional[str]) -> None:
+    """Append the spans of traced requests to `path`, one JSON object a line.
+
+    Each span has the `trace_id`, the `service` and `name` of the hop, its
+    `end` as a Unix time, its `duration` in seconds and its `attributes`.
+    Without a path, nothing is recorded.
+    """
+    global _enabled
+    if not path:
+        return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    _enabled = True
+
+
+def begin(trace_id: Optional[str]) -> str:
+    """Trace the current request under `trace_id`, or a new id if it is invalid."""
+    if trace_id is None or not VALID_TRACE_ID.fullmatch(trace_id):
+        trace_id = uuid.uuid4().hex
+    _current.set(trace_id)
+    return trace_id
+
+
+def end() -> None:
+    _current.set(None)
+
+
+def current() -> Optional[str]:
+    """Trace id of the current request, if any."""
+    return _current.get()
+
+
+def record(name: str, duration: float, **attributes: Any) -> None:
+    """Record a span of the current request that ends now."""
+    trace_id = _current.get()
+    if not _enabled or trace_id is None:
+        return
+    span = {
+        "trace_id": trace_id,
+        "service": SERVICE,
+        "name": name,
+        "end": time.time(),
+        "duration": duration,
+        "attributes": attributes,
+    }
+    logger.info(json.dumps(span))
@@ -0,0 +1,36 @@
+import argparse
+import logging
+from flask import Flask
+from config import Config
+from messengerdb import db
+from messengerdb.migrations import MIGRATIONS, applied_versions, upgrade
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply TChat schema migrations")
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="List the migrations and whether they are applied, without applying them",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+
+    with app.app_context():
+        if args.status:
+            applied = set(applied_versions(db.engine))
+            for version, name, _ in MIGRATIONS:
+                state = "applied" if version in applied else "pending"
+                print(f"{version:4d}  {state:8s} {name}")
+            return
+
+        applied = upgrade(db.engine)
+        print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+
+if __name__ == "__main__":
+    main()
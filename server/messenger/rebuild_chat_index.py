@@ -0,0 +1,42 @@
+import argparse
+from flask import Flask
+import redis
+from config import Config
+from messengerdb import db
+from messengerdb.chat_index import ChatIndex
+from messengerdb.messenger import UserManager, Users
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Repopulate the Redis chat lists of users from MySQL"
+    )
+    parser.add_argument(
+        "--user-id",
+        type=int,
+        action="append",
+        help="Rebuild only this user (can be repeated); all users by default",
+    )
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    redis_client = redis.StrictRedis(
+        host=app.config["REDIS_HOST"], port=app.config["REDIS_PORT"]
+    )
+    chat_index = ChatIndex(redis_client)
+
+    with app.app_context():
+        users = UserManager(db.session)
+        user_ids = args.user_id or [
+            user_id for (user_id,) in db.session.query(Users.id).order_by(Users.id)
+        ]
+        for user_id in user_ids:
+            chat_index.forget(user_id)
+            chat_index.rebuild(user_id, users.recent_chats(user_id))
+    print(f"Rebuilt the chat lists of {len(user_ids)} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
 from sanic import Sanic
+from sanic.response import raw
 import aiohttp
 import asyncio
 import os
 import json
+import shutil
+import time
 from sanic_redis import SanicRedis
 
+import metrics
+from compression import DeflateWebSocketProtocol
+import tracing
+from hub import (
+    Hub,
+    Subscriber,
+    entry_key,
+    event_frame,
+    publish_age,
+    resync_frame,
+)
+from sessions import SessionChecker
+
 
 app = Sanic("Notification-Server")
 
@@ -18,38 +34,400 @@ redis = SanicRedis()
 redis.init_app(app)
 
 
+STREAM_KEY = "events:{}"
+ROOM_CHANNEL = "room-{}"
+USER_CHANNEL = "user-{}"
+DEFAULT_ROOM = "public_room"
+MAX_ROOMS = int(os.getenv("MAX_ROOMS", 50))
+MESSENGER_URL = os.getenv("MESSENGER_URL", "http://messenger-app:13247")
+SESSION_CHECK_TTL = float(os.getenv("SESSION_CHECK_TTL", 5))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", 256))
+# Send commands of a socket waiting for the messenger; more are refused
+MAX_PENDING_SENDS = int(os.getenv("MAX_PENDING_SENDS", 64))
+# Ack of each stored send command, so that a resent command is not stored
+# again; the key holds "pending" while the first send waits for the messenger.
+SENT_KEY = "socket-sent:{}:{}"
+SENT_TTL = int(os.getenv("SENT_TTL", 600))
+SENT_PENDING = b"pending"
+SENT_PENDING_TTL = 30  # Longer than the timeout of the messenger requests
+SENT_WAIT_SECONDS = 15
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "disconnect")
+# Close code "try again later", sent to sockets that could not keep up
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Batching defaults, and the largest values a client may ask for
+BATCH_FRAMES = 50
+BATCH_DELAY_MS = 5
+MAX_BATCH_FRAMES = 200
+MAX_BATCH_DELAY_MS = 50
+# "deflate" negotiates permessage-deflate with the clients that offer it
+WEBSOCKET_COMPRESSION = os.getenv("WEBSOCKET_COMPRESSION", "deflate")
+# JSON-lines file that receives the spans of traced messages; empty is off
+TRACE_LOG = os.getenv("TRACE_LOG", "")
+
+
+tracing.configure(TRACE_LOG)
+
+
+@app.main_process_start
+async def clear_metrics(app, loop):
+    # Metric files from a previous run would be summed into the new one.
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+@app.listener("before_server_start")
+async def start_services(app, loop):
+    app.ctx.hub = Hub(redis.conn)
+    await app.ctx.hub.start()
+    # One pooled client for every request to the messenger
+    app.ctx.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    app.ctx.sessions = SessionChecker(
+        redis.conn,
+        app.ctx.http,
+        f"{MESSENGER_URL}/api/user/is_session_valid",
+        ttl=SESSION_CHECK_TTL,
+    )
+
+
+@app.listener("after_server_stop")
+async def stop_services(app, loop):
+    await app.ctx.hub.stop()
+    await app.ctx.http.close()
+
+
+def decode_positions(last_event_ids, channels):
+    """Entry keys of the `{channel: entry id}` a client saw last."""
+    positions = {}
+    if isinstance(last_event_ids, dict):
+        for channel, entry_id in last_event_ids.items():
+            try:
+                if channel in channels:
+                    positions[channel] = entry_key(entry_id)
+            except (ValueError, AttributeError):
+                pass
+    return positions
+
+
+def room_channels(rooms):
+    """Channels of the valid room names in `rooms`, at most `MAX_ROOMS`."""
+    channels = []
+    for room_name in rooms if isinstance(rooms, list) else []:
+        channel = ROOM_CHANNEL.format(room_name)
+        valid = isinstance(room_name, str) and 0 < len(room_name) <= 100
+        if valid and channel not in channels and len(channels) < MAX_ROOMS:
+            channels.append(channel)
+    return channels
+
+
+def batch_settings(requested):
+    """`(max_frames, max_delay)` from the `batch` field of the handshake.
+
+    `true` picks the defaults; a dict may ask for `max_frames` and
+    `max_delay_ms`, capped by the server. Returns None without batching.
+    """
+    if requested is True:
+        requested = {}
+    if not isinstance(requested, dict):
+        return None
+    try:
+        max_frames = int(requested.get("max_frames", BATCH_FRAMES))
+        max_delay_ms = float(requested.get("max_delay_ms", BATCH_DELAY_MS))
+    except (TypeError, ValueError):
+        return None
+    max_frames = min(max_frames, MAX_BATCH_FRAMES)
+    max_delay_ms = min(max(max_delay_ms, 0.0), MAX_BATCH_DELAY_MS)
+    if max_frames < 2:
+        return None
+    return max_frames, max_delay_ms / 1000
+
+
+async def send_frames(ws, frames, batch):
+    """Send encoded frames; when batching, as JSON arrays of several frames."""
+    if batch is None:
+        for frame in frames:
+            await ws.send(frame)
+            metrics.FRAMES_SENT.inc()
+        return
+    max_frames, _ = batch
+    for start in range(0, len(frames), max_frames):
+        chunk = frames[start : start + max_frames]
+        await ws.send(chunk[0] if len(chunk) == 1 else "[" + ",".join(chunk) + "]")
+        metrics.FRAMES_SENT.inc(len(chunk))
+
+
+async def replay(redis_client, positions):
+    """Frames of the entries the client missed since its last seen ones.
+
+    When the log of a channel no longer holds every entry after the position
+    (it was trimmed or expired), the client is asked to resync that channel.
+    """
+    frames = []
+    entries = []
+    for channel, last_key in list(positions.items()):
+        key = STREAM_KEY.format(channel)
+        first = await redis_client.xrange(key, count=1)
+        if not first or entry_key(first[0][0].decode()) > last_key:
+            del positions[channel]
+            frames.append(resync_frame(channel))
+            continue
+        last_id = "-".join(map(str, last_key))
+        for entry_id, fields in await redis_client.xrange(key, min=f"({last_id}"):
+            entry_id = entry_id.decode()
+            frame = event_frame(channel, entry_id, fields[b"data"].decode())
+            entries.append((channel, entry_key(entry_id), frame))
+
+    entries.sort(key=lambda entry: entry[1])
+    for channel, key, frame in entries:
+        positions[channel] = key
+        frames.append(frame)
+    return frames
+
+
+def observe_delivery(sent):
+    """Publish-to-send latency of the sent `(channel, key, trace id)` messages."""
+    for channel, key, trace_id in sent:
+        seconds = publish_age(key)
+        metrics.DELIVERY_SECONDS.observe(seconds)
+        tracing.record(trace_id, "send", seconds, channel=channel)
+
+
+async def forward(subscriber, ws, positions, batch=None):
+    """Send the queued frames; a slow socket only delays its own queue.
+
+    When batching, frames that arrive within the delay of the first one are
+    sent together.
+    """
+    while True:
+        items = [await subscriber.get()]
+        if batch is not None and items[0] is not None:
+            max_frames, max_delay = batch
+            if len(subscriber.queue) < max_frames - 1:
+                await asyncio.sleep(max_delay)
+            items += subscriber.take(max_frames - 1)
+
+        frames = []
+        sent = []
+        for item in items:
+            if item is None:
+                await send_frames(ws, frames, batch)
+                observe_delivery(sent)
+                if subscriber.overflowed:
+                    await ws.close(
+                        SLOW_CONSUMER_CLOSE_CODE,
+                        "Too slow, resume with last_event_ids",
+                    )
+                return
+            channel, key, frame, trace_id = item
+            if key is not None:
+                last_key = positions.get(channel)
+                if last_key is not None and key <= last_key:
+                    # Already sent by the replay.
+                    continue
+                positions[channel] = key
+                sent.append((channel, key, trace_id))
+            frames.append(frame)
+        await send_frames(ws, frames, batch)
+        observe_delivery(sent)
+
+
+async def send_message(http, user, command):
+    """Store a message sent on the socket through the messenger's send route.
+
+    The sender is the user of the socket, and the request is traced under the
+    `trace_id` of the command. Returns the ack frame, which carries the
+    `client_id` of the command and the id of the stored message.
+    """
+    kind = command.get("kind")
+    if kind == "public":
+        data = {
+            "user_id": user["user_id"],
+            "message": command.get("message"),
+            "room_name": command.get("room_name", DEFAULT_ROOM),
+            "name": command.get("name"),
+        }
+    elif kind == "private":
+        data = {
+            "sender_id": user["user_id"],
+            "receiver_id": command.get("receiver_id"),
+            "message": command.get("message"),
+            "name": command.get("name"),
+        }
+    else:
+        data = None
+
+    result = {}
+    if data is not None:
+        trace_id = tracing.trace_id_of(command.get("trace_id"))
+        headers = {
+            "User-Id": str(user["user_id"]),
+            "Session-Id": user["session_id"],
+            tracing.HEADER: trace_id,
+        }
+        started = time.perf_counter()
+        try:
+            async with http.post(
+                f"{MESSENGER_URL}/api/{kind}/send_message", json=data, headers=headers
+            ) as response:
+                result = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"Error: {e}")
+        tracing.record(
+            trace_id,
+            "socket_send",
+            time.perf_counter() - started,
+            kind=kind,
+            success=result.get("success", False),
+        )
+    return ack_frame(command, result)
+
+
+def ack_frame(command, result):
+    return json.dumps(
+        {
+            "where": "ack",
+            "client_id": command.get("client_id"),
+            "success": result.get("success", False),
+            "id": result.get("id"),
+        }
+    )
+
+
+async def send_once(http, conn, user, command):
+    """`send_message`, or the ack of the first send of a resent command.
+
+    Commands are told apart by the user of the socket and their `client_id`.
+    A resend that arrives while the first send still waits for the messenger
+    waits for its ack, for at most `SENT_WAIT_SECONDS`.
+    """
+    client_id = command.get("client_id")
+    if not isinstance(client_id, str) or not client_id:
+        return await send_message(http, user, command)
+
+    key = SENT_KEY.format(user["user_id"], client_id)
+    deadline = time.monotonic() + SENT_WAIT_SECONDS
+    while True:
+        if await conn.set(key, SENT_PENDING, ex=SENT_PENDING_TTL, nx=True):
+            ack = await send_message(http, user, command)
+            if json.loads(ack)["success"]:
+                await conn.set(key, ack, ex=SENT_TTL)
+            else:
+                # Not stored, so a resend may try again.
+                await conn.delete(key)
+            return ack
+        ack = await conn.get(key)
+        if ack is not None and ack != SENT_PENDING:
+            return ack.decode()
+        if time.monotonic() > deadline:
+            return ack_frame(command, {})
+        await asyncio.sleep(0.1)
+
+
+async def send_messages(http, conn, ws, user, sends):
+    """Store the send commands queued on `sends`, in order, and ack them."""
+    while True:
+        command = await sends.get()
+        await ws.send(await send_once(http, conn, user, command))
+
+
+async def read_commands(app, subscriber, ws, sends, rooms, positions):
+    """Apply the frames the client sends on the socket.
+
+    `{"action": "join" | "leave", "room_name": ...}` changes the rooms of the
+    socket. `{"action": "send", "client_id": ..., "kind": ..., ...}` sends a
+    message with the fields of the public or private send route, and is
+    answered with an ack frame. Sends are queued for `send_messages`, so room
+    changes do not wait for the messenger; beyond `MAX_PENDING_SENDS` they
+    are refused with a failed ack.
+    """
+    async for frame in ws:
+        try:
+            command = json.loads(frame)
+            action = command["action"]
+        except (ValueError, TypeError, KeyError):
+            continue
+        if action == "send":
+            try:
+                sends.put_nowait(command)
+            except asyncio.QueueFull:
+                await ws.send(ack_frame(command, {}))
+            continue
+
+        try:
+            (channel,) = room_channels([command.get("room_name")])
+        except ValueError:
+            continue
+        if action == "join" and channel not in rooms and len(rooms) < MAX_ROOMS:
+            rooms.append(channel)
+            await app.ctx.hub.subscribe(subscriber, channel)
+        elif action == "leave" and channel in rooms:
+            rooms.remove(channel)
+            positions.pop(channel, None)
+            await app.ctx.hub.unsubscribe(subscriber, channel)
+
+
+@app.get("/metrics")
+async def metrics_endpoint(request):
+    data, content_type = metrics.render()
+    return raw(data, content_type=content_type)
+
+
 @app.websocket("/notifications")
 async def feed(request, ws):
+    hub = request.app.ctx.hub
+    subscriber = Subscriber(SEND_QUEUE_SIZE, SLOW_CONSUMER_POLICY)
+    metrics.OPEN_WEBSOCKETS.inc()
     try:
         data = await ws.recv()
         data = json.loads(data)
+        last_event_ids = data.pop("last_event_ids", None)
+        rooms = room_channels(data.pop("rooms", [DEFAULT_ROOM]))
+        batch = batch_settings(data.pop("batch", None))
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "http://messenger-app:13247/api/user/is_session_valid", json=data
-            ) as response:
-                if response.status != 200:
-                    return
+        sessions = request.app.ctx.sessions
+        started = time.perf_counter()
+        valid = await sessions.is_valid(data.get("user_id"), data.get("session_id"))
+        metrics.HANDSHAKE_SECONDS.labels("valid" if valid else "invalid").observe(
+            time.perf_counter() - started
+        )
+        if not valid:
+            return
 
-                result = await response.json()
-                if not result.get("success", False):
-                    return
-
-        async with redis.conn as redis_client:
-            pubsub = redis_client.pubsub()
-            await pubsub.subscribe("public_room", f'user-{data["user_id"]}')
-            async for message in pubsub.listen():
-                if message["type"] == "message":
-                    msg = message["data"].decode("utf-8")
-                    where = (
-                        "public" if message["channel"] == b"public_room" else "private"
-                    )
-                    await ws.send(json.dumps({"where": where, "content": msg}))
+        user_channel = USER_CHANNEL.format(data["user_id"])
+        positions = decode_positions(last_event_ids, [*rooms, user_channel])
+        # Subscribe first, so nothing published during the replay is lost;
+        # live frames wait in the queue meanwhile.
+        await hub.subscribe(subscriber, *rooms, user_channel)
+        await send_frames(ws, await replay(redis.conn, positions), batch)
+        sends = asyncio.Queue(MAX_PENDING_SENDS)
+        tasks = [
+            asyncio.create_task(forward(subscriber, ws, positions, batch)),
+            asyncio.create_task(
+                read_commands(request.app, subscriber, ws, sends, rooms, positions)
+            ),
+            asyncio.create_task(
+                send_messages(request.app.ctx.http, redis.conn, ws, data, sends)
+            ),
+        ]
+        # The socket closed, sending to it failed, or the hub lost Redis.
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
     except Exception as e:
         print(f"Error: {e}")
     finally:
+        await hub.unsubscribe(subscriber, *subscriber.channels)
+        subscriber.discard()
+        metrics.OPEN_WEBSOCKETS.dec()
         await ws.close()
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=13246)
+    # The protocol can not be chosen through the `sanic` command.
+    protocol = None
+    if WEBSOCKET_COMPRESSION == "deflate":
+        protocol = DeflateWebSocketProtocol
+    app.run(host="0.0.0.0", port=13246, fast=True, protocol=protocol)
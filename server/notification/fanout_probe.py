@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import json
+import socket
+import uuid
+
+import aiohttp
+import redis.asyncio as aioredis
+from prometheus_client.parser import text_string_to_metric_families
+
+RECEIVED = "notification_redis_messages_total"
+
+
+async def open_socket(http, args, index):
+    """Register and log in a probe user, then open its notification socket."""
+    username = f"probe{index}{uuid.uuid4().hex[:8]}"
+    password = f"Probe-{uuid.uuid4().hex}"
+    await http.post(
+        f"{args.messenger_url}/api/user/register",
+        json={
+            "username": username,
+            "name": username,
+            "password": password,
+            "email": f"{username}@example.com",
+        },
+    )
+    async with http.post(
+        f"{args.messenger_url}/api/user/login",
+        json={"username": username, "password": password},
+    ) as response:
+        user = await response.json()
+
+    # Offers permessage-deflate, as the client does.
+    ws = await http.ws_connect(
+        f"{args.url}?user_id={user['user_id']}", ssl=False, heartbeat=30, compress=15
+    )
+    await ws.send_str(
+        json.dumps(
+            {"user_id": user["user_id"], "session_id": user["session_id"], "rooms": []}
+        )
+    )
+    return user["user_id"], ws
+
+
+async def count_frames(ws, expected, timeout):
+    received = 0
+    try:
+        async with asyncio.timeout(timeout):
+            while received < expected:
+                message = await ws.receive()
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                frame = json.loads(message.data)
+                received += len(frame) if isinstance(frame, list) else 1
+    except TimeoutError:
+        pass
+    return received
+
+
+async def node_counts(http, host, port):
+    """Messages each notification node has received from Redis so far."""
+    addresses = {info[4][0] for info in socket.getaddrinfo(host, port)}
+    counts = {}
+    for address in sorted(addresses):
+        async with http.get(f"http://{address}:{port}/metrics") as response:
+            text = await response.text()
+        counts[address] = sum(
+            sample.value
+            for family in text_string_to_metric_families(text)
+            for sample in family.samples
+            if sample.name == RECEIVED
+        )
+    return counts
+
+
+async def probe(args):
+    async with aiohttp.ClientSession() as http:
+        sockets = [await open_socket(http, args, i) for i in range(args.users)]
+        # Let every node subscribe to the channels of its sockets.
+        await asyncio.sleep(2)
+        before = await node_counts(http, args.nodes_host, args.nodes_port)
+
+        redis_client = aioredis.StrictRedis(host=args.redis_host, port=args.redis_port)
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id, _ in sockets:
+            for i in range(args.messages):
+                payload = json.dumps([i, 0, user_id, "probe", "", "probe"])
+                pipe.publish(f"user-{user_id}", f"0-{i + 1} - {payload}")
+        await pipe.execute()
+        await redis_client.aclose()
+
+        delivered = await asyncio.gather(
+            *(count_frames(ws, args.messages, args.timeout) for _, ws in sockets)
+        )
+        after = await node_counts(http, args.nodes_host, args.nodes_port)
+        for _, ws in sockets:
+            await ws.close()
+
+    published = args.users * args.messages
+    print(f"Published {published} messages to {args.users} users")
+    print(f"Delivered {sum(delivered)} frames to the sockets")
+    compressed = sum(bool(ws.compress) for _, ws in sockets)
+    print(f"Negotiated permessage-deflate on {compressed} of {len(sockets)} sockets")
+    for address, count in after.items():
+        received = count - before.get(address, 0)
+        print(
+            f"{address}: received {received:.0f} messages from Redis "
+            f"({received / published:.0%} of the traffic)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how Redis fan-out is split across notification nodes"
+    )
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=10, help="per user")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--url", default="wss://nginx/notifications/")
+    parser.add_argument("--messenger-url", default="http://messenger-app:13247")
+    parser.add_argument("--nodes-host", default="notification-app")
+    parser.add_argument("--nodes-port", type=int, default=13246)
+    parser.add_argument("--redis-host", default="redis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    asyncio.run(probe(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
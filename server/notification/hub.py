@@ -0,0 +1,232 @@
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from redis.exceptions import RedisError
+
+import tracing
+
+from metrics import (
+    CHANNEL_FOLLOWERS,
+    FRAMES_DROPPED,
+    REDIS_MESSAGES,
+    SEND_QUEUE_FRAMES,
+    SLOW_CONSUMER_DISCONNECTS,
+    SUBSCRIBED_CHANNELS,
+    SUBSCRIPTIONS,
+)
+
+
+def entry_key(entry_id):
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+def where(channel):
+    return "public" if channel.startswith("room-") else "private"
+
+
+def event_frame(channel, entry_id, content):
+    # `content` is the JSON the messenger published; it is embedded as is, so
+    # the message is neither decoded here nor encoded twice for the client.
+    head = json.dumps({"where": where(channel), "channel": channel, "id": entry_id})
+    return f'{head[:-1]}, "content": {content}}}'
+
+
+def publish_age(key):
+    """Seconds since the publish of an entry.
+
+    Redis assigns the entry id when the messenger publishes the message, so
+    its milliseconds are the publish time.
+    """
+    return max(time.time() - key[0] / 1000, 0.0)
+
+
+def resync_frame(channel):
+    return json.dumps({"where": "resync", "content": where(channel)})
+
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class Subscriber:
+    """Bounded queue of the frames waiting to be sent to one websocket.
+
+    Items are `(channel, entry key, frame, trace id)`; None means the socket
+    must close.
+    When the queue is full, `policy` decides what gives way: `drop_oldest`
+    drops the oldest frame, `coalesce` replaces the queued frames of each
+    channel with one resync frame, and `disconnect` closes the socket, which
+    can then resume from its last event ids.
+    """
+
+    def __init__(self, maxsize=256, policy=DISCONNECT):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.channels = set()
+        self.closed = False
+        self.overflowed = False
+        self._ready = asyncio.Event()
+
+    def deliver(self, item):
+        if self.closed:
+            return
+        if len(self.queue) >= self.maxsize:
+            self._overflow()
+            if self.closed:
+                return
+        self.queue.append(item)
+        SEND_QUEUE_FRAMES.inc()
+        self._ready.set()
+
+    async def get(self):
+        while not self.queue:
+            self._ready.clear()
+            await self._ready.wait()
+        item = self.queue.popleft()
+        if item is not None:
+            SEND_QUEUE_FRAMES.dec()
+        return item
+
+    def take(self, limit):
+        """Up to `limit` more queued items, without waiting."""
+        items = []
+        while self.queue and len(items) < limit:
+            item = self.queue.popleft()
+            items.append(item)
+            if item is None:
+                break
+        SEND_QUEUE_FRAMES.dec(sum(item is not None for item in items))
+        return items
+
+    def close(self):
+        if not self.closed:
+            self.discard()
+            self.queue.append(None)
+            self._ready.set()
+
+    def discard(self):
+        """Drop the queued frames; nothing is delivered afterwards."""
+        self.closed = True
+        SEND_QUEUE_FRAMES.dec(sum(item is not None for item in self.queue))
+        self.queue.clear()
+
+    def _overflow(self):
+        if self.policy == DISCONNECT:
+            SLOW_CONSUMER_DISCONNECTS.inc()
+            self.overflowed = True
+            self.close()
+            return
+
+        dropped = len(self.queue)
+        if self.policy == COALESCE:
+            channels = dict.fromkeys(channel for channel, *_ in self.queue)
+            self.queue = deque(
+                (channel, None, resync_frame(channel), None) for channel in channels
+            )
+        if len(self.queue) >= self.maxsize:
+            self.queue.popleft()
+        dropped -= len(self.queue)
+        FRAMES_DROPPED.labels(self.policy).inc(dropped)
+        SEND_QUEUE_FRAMES.dec(dropped)
+
+
+class Hub:
+    """One Redis subscription per process, shared by all of its websockets.
+
+    Channels are subscribed while at least one local socket follows them. Each
+    message is decoded and encoded once, then queued for every local follower.
+    """
+
+    def __init__(self, redis_client):
+        self.pubsub = redis_client.pubsub()
+        self.subscribers = defaultdict(set)
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def start(self):
+        # Connected here, so that `subscribe` and `run` share one connection.
+        await self.pubsub.connect()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.pubsub.aclose()
+
+    async def subscribe(self, subscriber, *channels):
+        async with self._lock:
+            new = []
+            for channel in channels:
+                if not self.subscribers[channel]:
+                    new.append(channel)
+                    SUBSCRIBED_CHANNELS.labels(where(channel)).inc()
+                if subscriber not in self.subscribers[channel]:
+                    SUBSCRIPTIONS.labels(where(channel)).inc()
+                self.subscribers[channel].add(subscriber)
+                subscriber.channels.add(channel)
+            if new:
+                await self.pubsub.subscribe(*new)
+
+    async def unsubscribe(self, subscriber, *channels):
+        async with self._lock:
+            unused = []
+            for channel in channels:
+                followers = self.subscribers.get(channel)
+                if followers is None or subscriber not in followers:
+                    continue
+                followers.discard(subscriber)
+                subscriber.channels.discard(channel)
+                SUBSCRIPTIONS.labels(where(channel)).dec()
+                if not followers:
+                    del self.subscribers[channel]
+                    unused.append(channel)
+                    SUBSCRIBED_CHANNELS.labels(where(channel)).dec()
+            if unused:
+                try:
+                    await self.pubsub.unsubscribe(*unused)
+                except RedisError as e:
+                    # Messages of channels nobody follows are dropped anyway.
+                    print(f"Error: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                while True:
+                    message = await self.pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    if message is not None and message["type"] == "message":
+                        self.dispatch(message["channel"], message["data"])
+            except RedisError as e:
+                print(f"Error: {e}")
+                # Messages may have been missed while disconnected; reconnecting
+                # clients get them back from the event log.
+                for followers in list(self.subscribers.values()):
+                    for subscriber in list(followers):
+                        subscriber.close()
+                await asyncio.sleep(1)
+
+    def dispatch(self, channel, data):
+        REDIS_MESSAGES.inc()
+        channel = channel.decode("utf-8")
+        entry_id, trace_id, content = data.decode("utf-8").split(" ", 2)
+        key = entry_key(entry_id)
+        item = (channel, key, event_frame(channel, entry_id, content), trace_id)
+        followers = self.subscribers.get(channel, ())
+        CHANNEL_FOLLOWERS.observe(len(followers))
+        tracing.record(
+            trace_id,
+            "receive",
+            publish_age(key),
+            channel=channel,
+            followers=len(followers),
+        )
+        for subscriber in followers:
+            subscriber.deliver(item)
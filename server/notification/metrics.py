@@ -0,0 +1,78 @@
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+OPEN_WEBSOCKETS = Gauge(
+    "notification_open_websockets",
+    "Open websockets, including the ones still in their handshake",
+    multiprocess_mode="livesum",
+)
+HANDSHAKE_SECONDS = Histogram(
+    "notification_handshake_validation_seconds",
+    "Time taken to validate the session of a new websocket, by result",
+    ["result"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+SUBSCRIPTIONS = Gauge(
+    "notification_subscriptions",
+    "Channels followed by the open websockets, by kind of channel",
+    ["kind"],
+    multiprocess_mode="livesum",
+)
+SUBSCRIBED_CHANNELS = Gauge(
+    "notification_subscribed_channels",
+    "Channels the hubs are subscribed to in Redis, by kind of channel",
+    ["kind"],
+    multiprocess_mode="livesum",
+)
+REDIS_MESSAGES = Counter(
+    "notification_redis_messages_total",
+    "Messages received from Redis by the hub of this node",
+)
+CHANNEL_FOLLOWERS = Histogram(
+    "notification_channel_followers",
+    "Local websockets each message from Redis is queued for",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+FRAMES_SENT = Counter(
+    "notification_frames_sent_total",
+    "Event and resync frames sent to websockets, counted one by one in batches",
+)
+DELIVERY_SECONDS = Histogram(
+    "notification_delivery_seconds",
+    "Time from the publish of a message to its send on a websocket",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+SEND_QUEUE_FRAMES = Gauge(
+    "notification_send_queue_frames",
+    "Frames waiting in the send queues of the open websockets",
+    multiprocess_mode="livesum",
+)
+FRAMES_DROPPED = Counter(
+    "notification_frames_dropped_total",
+    "Frames dropped from full send queues, by slow-consumer policy",
+    ["policy"],
+)
+SLOW_CONSUMER_DISCONNECTS = Counter(
+    "notification_slow_consumer_disconnects_total",
+    "Websockets closed because their send queue was full",
+)
+
+
+def render():
+    # Sanic runs several workers, each with its own values; in that case they
+    # are shared through files in PROMETHEUS_MULTIPROC_DIR.
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
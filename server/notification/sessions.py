@@ -0,0 +1,76 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+
+class SessionChecker:
+    """Validate handshake sessions without a request per socket.
+
+    Sessions are looked up in a short-lived local cache first, then in the
+    Redis tier of the messenger's session cache (`session:<session_id>`), and
+    only then asked to the messenger over the pooled HTTP client. Concurrent
+    checks of the same session share one request. Only valid sessions are
+    cached; `ttl` bounds how long a logged-out session is still accepted.
+    """
+
+    KEY_PREFIX = "session:"
+
+    def __init__(self, redis_client, http, url, ttl=5.0, maxsize=10000):
+        self.redis = redis_client
+        self.http = http
+        self.url = url
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._valid = OrderedDict()  # (user_id, session_id) -> expires_at
+        self._pending = {}
+
+    async def is_valid(self, user_id, session_id):
+        key = (user_id, session_id)
+        if self._recall(key):
+            return True
+
+        try:
+            cached = await self.redis.get(self.KEY_PREFIX + str(session_id))
+        except RedisError as e:
+            print(f"Error: {e}")
+            cached = None
+        if cached is not None and cached.decode() == str(user_id):
+            self._remember(key)
+            return True
+
+        request = self._pending.get(key)
+        if request is None:
+            request = asyncio.ensure_future(self._ask(user_id, session_id))
+            self._pending[key] = request
+            request.add_done_callback(lambda _: self._pending.pop(key, None))
+        # A socket that goes away must not cancel the check of the others.
+        valid = await asyncio.shield(request)
+        if valid:
+            self._remember(key)
+        return valid
+
+    async def _ask(self, user_id, session_id):
+        data = {"user_id": user_id, "session_id": session_id}
+        async with self.http.post(self.url, json=data) as response:
+            if response.status != 200:
+                return False
+            result = await response.json()
+            return result.get("success", False)
+
+    def _recall(self, key):
+        expires_at = self._valid.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._valid[key]
+            return False
+        self._valid.move_to_end(key)
+        return True
+
+    def _remember(self, key):
+        self._valid[key] = time.monotonic() + self.ttl
+        self._valid.move_to_end(key)
+        while len(self._valid) > self.maxsize:
+            self._valid.popitem(last=False)
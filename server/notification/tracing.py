@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+# Header carrying the trace id on the requests to the messenger
+HEADER = "X-Trace-Id"
+
+# Pub/sub messages of untraced requests carry this instead of a trace id.
+NO_TRACE = "-"
+
+VALID_TRACE_ID = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+SERVICE = "notification"
+
+logger = logging.getLogger("tchat.trace")
+logger.propagate = False
+
+_enabled = False
+
+
+def configure(path):
+    """Append spans to `path`, one JSON object a line, in the messenger's format.
+
+    Each span has the `trace_id`, the `service` and `name` of the hop, its
+    `end` as a Unix time, its `duration` in seconds and its `attributes`.
+    Without a path, nothing is recorded.
+    """
+    global _enabled
+    if not path:
+        return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    _enabled = True
+
+
+def trace_id_of(value):
+    """`value` if it is a valid trace id, else a new one."""
+    if isinstance(value, str) and VALID_TRACE_ID.fullmatch(value):
+        return value
+    return uuid.uuid4().hex
+
+
+def record(trace_id, name, duration, **attributes):
+    """Record a span that ends now; untraced messages are skipped."""
+    if not _enabled or trace_id is None or trace_id == NO_TRACE:
+        return
+    span = {
+        "trace_id": trace_id,
+        "service": SERVICE,
+        "name": name,
+        "end": time.time(),
+        "duration": duration,
+        "attributes": {"pid": os.getpid(), **attributes},
+    }
+    logger.info(json.dumps(span))
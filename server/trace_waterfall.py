@@ -0,0 +1,58 @@
+import argparse
+import glob
+import json
+import os
+
+BAR_WIDTH = 40
+
+
+def load_spans(paths, trace_id):
+    spans = []
+    for path in paths:
+        with open(path) as trace_log:
+            for line in trace_log:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if span.get("trace_id") == trace_id:
+                    span["start"] = float(span["end"]) - float(span["duration"])
+                    spans.append(span)
+    return sorted(spans, key=lambda span: span["start"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the latency waterfall of a traced request"
+    )
+    parser.add_argument("trace_id")
+    parser.add_argument(
+        "--dir",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces"),
+        help="directory of the *.jsonl trace logs",
+    )
+    args = parser.parse_args()
+
+    spans = load_spans(
+        sorted(glob.glob(os.path.join(args.dir, "*.jsonl"))), args.trace_id
+    )
+    if not spans:
+        print(f"No spans of trace {args.trace_id} in {args.dir}")
+        return
+
+    origin = spans[0]["start"]
+    total = max(float(span["end"]) for span in spans) - origin or 1.0
+    for span in spans:
+        offset = span["start"] - origin
+        duration = float(span["duration"])
+        left = int(offset / total * BAR_WIDTH)
+        bar = " " * left + "#" * max(1, int(duration / total * BAR_WIDTH))
+        print(
+            f"{offset * 1000:9.1f} ms {duration * 1000:9.1f} ms  "
+            f"|{bar:<{BAR_WIDTH}}|  {span['service']} {span['name']} "
+            f"{json.dumps(span.get('attributes', {}))}"
+        )
+
+
+if __name__ == "__main__":
+    main()